@@ -1,11 +1,19 @@
 import os
-import pickle
+import json
+import sys
+import hashlib
+from multiprocessing import Pool
+import plotly.io as pio
 import pandas as pd
 import numpy as np
 import scipy.stats as stats
 import itertools
 import plotly.graph_objects as go
-from monte_carlo import monte_carlo_results
+from monte_carlo import monte_carlo_results, monte_carlo_batch, EXPERIMENT_SAMPLER
+from mc_cache import MCCache, CACHE_PATH
+from store import (load_points, store_path, point_names, load_solution, variable_values,
+                   read_results, results_line)
+from gpkit import NamedVariables
 from simpleac import SimPleAC
 
 analysis_plot_dir = "./analysis/"
@@ -13,12 +21,60 @@ folder_names = ["./data/control/", "./data/margin/", "./data/robust_performance/
 conditions = ["Control", "Margin", "Gamma Slider", "Performance Slider"]
 
 
+# in report mode figures are queued for export_report instead of shown and saved
+report = {"enabled": False, "queue": []}
+REPORT_MANIFEST = "report_manifest.json"
+
+
+def output_figure(fig, name=None):
+    if report["enabled"]:
+        if name is not None:
+            report["queue"].append((name, fig.to_json()))
+        return
+    fig.show()
+    if name is not None:
+        if not os.path.exists(analysis_plot_dir):
+            os.mkdir(analysis_plot_dir)
+        fig.write_image(analysis_plot_dir+name+".png")
+
+
+def _export_figure(task):
+    path, fig_json = task
+    pio.from_json(fig_json).write_image(path)
+
+
+'''
+Renders the queued report figures to analysis_plot_dir on processes workers,
+skipping any whose figure JSON hashes the same as at its last export.
+'''
+def export_report(processes=None):
+    if not os.path.exists(analysis_plot_dir):
+        os.mkdir(analysis_plot_dir)
+    manifest_file = analysis_plot_dir + REPORT_MANIFEST
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    tasks = []
+    for name, fig_json in report["queue"]:
+        path = analysis_plot_dir + name + ".png"
+        digest = hashlib.sha1(fig_json.encode()).hexdigest()
+        if manifest.get(name) != digest or not os.path.isfile(path):
+            tasks.append((path, fig_json))
+            manifest[name] = digest
+    if tasks:
+        with Pool(processes) as pool:
+            pool.map(_export_figure, tasks)
+        _write_atomic(manifest_file, json.dumps(manifest))
+    report["queue"] = []
+    return len(tasks)
+
+
 def determine_settings(condition, folder_name, point_end="_point.txt"):
     ids = sorted(os.listdir(folder_name))
     for subject in ids:
         subj_path = folder_name + subject
-        subj_points = sorted([x for x in os.listdir(subj_path)
-                         if not x.endswith(".txt")], key = int)
+        subj_points = point_names(subj_path)
         for subj_point in subj_points:
             point_path = subj_path + "/" + subj_point
             if os.path.isfile(point_path + point_end):
@@ -26,13 +82,13 @@ def determine_settings(condition, folder_name, point_end="_point.txt"):
                     all_lines = f.readlines()
                 if all_lines[0] == "unknown\n":
                     settings = []
-                    with open(point_path, "rb") as f:
-                        sol = pickle.load(f)
+                    sol = load_solution(point_path)
                     if condition == conditions[0]:
-                        settings.append((sol("A").magnitude*sol("S").magnitude)**0.5)
-                        settings.append(sol("S").magnitude)
-                        settings.append(sol("V_{f_{avail}}").magnitude)
-                        settings.append(sol("C_L").magnitude)
+                        A, S, V_f_avail, C_L = variable_values(sol, ["A", "S", "V_{f_{avail}}", "C_L"])
+                        settings.append((A*S)**0.5)
+                        settings.append(S)
+                        settings.append(V_f_avail)
+                        settings.append(C_L)
                         print(subj_point)
                         print(settings)
                         with open(point_path + point_end, "w") as f:
@@ -40,10 +96,7 @@ def determine_settings(condition, folder_name, point_end="_point.txt"):
                             for line in all_lines[1:]:
                                 f.write(line)
                     elif condition == conditions[1]:
-                        settings.append(sol("m_ww").magnitude)
-                        settings.append(sol("m_tsfc").magnitude)
-                        settings.append(sol("m_vmin").magnitude)
-                        settings.append(sol("m_range").magnitude)
+                        settings.extend(variable_values(sol, ["m_ww", "m_tsfc", "m_vmin", "m_range"]))
                         print(subj_point)
                         print(settings)
                         with open(point_path + point_end, "w") as f:
@@ -52,34 +105,85 @@ def determine_settings(condition, folder_name, point_end="_point.txt"):
                                 f.write(line)
 
 
-def save_point(point_path, point_end="_point.txt", model_gen=SimPleAC, seed=246, settings="unknown"):
-    with open(point_path, "rb") as f:
-        sol = pickle.load(f)
-        perf, fail = monte_carlo_results(model_gen(), sol=sol, quiet=True, seed=seed)
-    with open(point_path + point_end, "w") as f:
-        f.write(str(settings) + "\n")
-        f.write(str(perf)+", "+str(fail))
+def rescore_path(point_path, sampler, point_end="_point.txt"):
+    # "<point>_point.txt" scored again with sampler -> "<point>_point_<sampler>.txt"
+    return point_path + point_end[:-len(".txt")] + "_%s.txt" % sampler
+
+
+def _write_results(point_path, point_end, settings, perf, fail, sampler, interval=None):
+    # a recorded results file is never rewritten; scores with another sampler go beside it
+    line = results_line(perf, fail, sampler, interval)
+    if os.path.isfile(point_path + point_end):
+        _write_atomic(rescore_path(point_path, sampler, point_end), line)
+    else:
+        _write_atomic(point_path + point_end, str(settings) + "\n" + line)
+
+
+def read_point(point_path, sampler=EXPERIMENT_SAMPLER, point_end="_point.txt"):
+    # (perf, fail) of a point as scored with sampler, or None if it has not been
+    for path, i in [(point_path + point_end, 1), (rescore_path(point_path, sampler, point_end), 0)]:
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                lines = f.readlines()
+            if len(lines) > i:
+                perf, fail, scored = read_results(lines[i])
+                if scored == sampler:
+                    return perf, fail
+    return None
+
+
+def save_point(point_path, point_end="_point.txt", model_gen=SimPleAC, seed=246, settings="unknown",
+               tol=None, cache=CACHE_PATH, sampler=EXPERIMENT_SAMPLER):
+    sol = load_solution(point_path)
+    results = monte_carlo_results(model_gen(), sol=sol, quiet=True, seed=seed, tol=tol,
+                                  cache=MCCache(cache) if cache else None, sampler=sampler)
+    perf, fail = results[:2]
+    # stopped early with tol: also keep the interval, samples and tol (see store.INTERVAL)
+    interval = (results[2] + (results[3], tol)) if tol and results[2] is not None else None
+    _write_results(point_path, point_end, settings, perf, fail, sampler, interval)
     return perf, fail
 
 
-def get_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, seed=246):
+def save_points(point_paths, point_end="_point.txt", model_gen=SimPleAC, seed=246, settings="unknown",
+                processes=None, cache=CACHE_PATH, sampler=EXPERIMENT_SAMPLER):
+    sols = [load_solution(point_path) for point_path in point_paths]
+    results = monte_carlo_batch(sols, seed=seed, model_gen=model_gen, processes=processes,
+                                cache=MCCache(cache) if cache else None, sampler=sampler)
+    for point_path, (perf, fail) in zip(point_paths, results):
+        _write_results(point_path, point_end, settings, float(perf), float(fail), sampler)
+    return results
+
+
+'''
+Every point of folder_name as scored with sampler; points without results of that
+sampler (see store.read_results) are scored first in one batch. A point's recorded
+results are kept as they are, and other samplers' scores go to rescore_path.
+'''
+def get_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, seed=246, cache=CACHE_PATH,
+               processes=None, sampler=EXPERIMENT_SAMPLER):
     pointids = {}
     idpoints = {}
     pointnum = {}
     ids = sorted(os.listdir(folder_name))
+    missing = [folder_name + subject + "/" + subj_point
+               for subject in ids
+               for subj_point in point_names(folder_name + subject)
+               if read_point(folder_name + subject + "/" + subj_point, sampler, point_end) is None]
+    if missing:
+        save_points(missing, point_end, model_gen, seed, processes=processes, cache=cache,
+                    sampler=sampler)
     for subject in ids:
         idpoints[subject] = []
         subj_path = folder_name + subject
-        subj_points = sorted([x for x in os.listdir(subj_path)
-                         if not x.endswith(".txt")], key = int)
+        subj_points = point_names(subj_path)
         for subj_point in subj_points:
             point_path = subj_path + "/" + subj_point
-            if os.path.isfile(point_path + point_end):
-                with open(point_path + point_end, "r") as f:
-                    pf_line = f.readlines()[1]
-                    perf, fail = [float(x) for x in pf_line.split(", ")]
+            scored = read_point(point_path, sampler, point_end)
+            if scored is not None:
+                perf, fail = scored
             else:
-                perf, fail = save_point(point_path, point_end=point_end, model_gen=model_gen, seed=seed)
+                perf, fail = save_point(point_path, point_end=point_end, model_gen=model_gen, seed=seed,
+                                        cache=cache, sampler=sampler)
             if (perf, fail) in pointids:
                 if subject not in pointids[(perf, fail)]:
                     pointids[(perf, fail)].append(subject)
@@ -90,43 +194,146 @@ def get_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, seed=246
     return pointids, idpoints, pointnum
 
 
-def corrected_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, seed=246):
+'''
+get_points from the condition's experiment table (see store.import_legacy) instead of
+the per-point files; only the subject, time, result and sampler columns are read.
+The fuel is as recorded, not corrected_points' nominal fuel. The table cannot
+re-score points, so those scored with another sampler are left out (and counted).
+'''
+def store_points(folder_name, sampler=EXPERIMENT_SAMPLER):
+    pointids = {}
+    idpoints = {}
+    pointnum = {}
+    points = load_points(store_path(folder_name),
+                         columns=["subject", "time", "performance", "failure", "sampler"],
+                         where='status == "point"')
+    other = points["sampler"] != sampler
+    if other.any():
+        print("%s: %i points scored with another sampler than %s left out"
+              % (folder_name, other.sum(), sampler))
+    points = points[~other].drop(columns="sampler")
+    points = points.dropna().sort_values(["subject", "time"], kind="mergesort")
+    for subject, group in points.groupby("subject", sort=True):
+        idpoints[subject] = []
+        for time, perf, fail in zip(group["time"], group["performance"], group["failure"]):
+            if (perf, fail) in pointids:
+                if subject not in pointids[(perf, fail)]:
+                    pointids[(perf, fail)].append(subject)
+            else:
+                pointids[(perf, fail)] = [subject]
+            pointnum[(perf, fail, subject)] = "%.0f" % time
+            idpoints[subject].append((perf, fail))
+    return pointids, idpoints, pointnum
+
+
+def manifest_path(folder_name, point_end="_point.txt"):
+    # "./data/control/" -> "./data/control_point_manifest.json"
+    return folder_name.rstrip("/") + point_end[:-len(".txt")] + "_manifest.json"
+
+
+def _write_atomic(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _signature(point_path, point_end, sampler):
+    # the point is redone if its pickle or results files changed or went missing
+    signature = []
+    for path in [point_path, point_path + point_end, rescore_path(point_path, sampler, point_end)]:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            signature += [stat.st_mtime_ns, stat.st_size]
+        else:
+            signature += [None, None]
+    return signature
+
+
+def _nominal_perf(point_path):
+    NamedVariables.reset_modelnumbers()
+    sol = load_solution(point_path)
+    design = ["S", "A", "V_{f_{avail}}", "C_L"]
+    nominal = SimPleAC(substitutions=dict(zip(design, variable_values(sol, design))))
+    try:
+        nomsol = nominal.localsolve(verbosity=0)
+        return nomsol("W_f").to("lbf").magnitude
+    except Exception:
+        return "SKIP"
+
+
+'''
+Points whose pickle and results are unchanged since the last run with the same
+sampler are read from the manifest next to folder_name; the rest get their missing
+Monte Carlo results (see get_points) and nominal solves on processes workers, with
+results written atomically.
+'''
+def corrected_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, seed=246,
+                     processes=None, cache=CACHE_PATH, sampler=EXPERIMENT_SAMPLER):
     pointids = {}
     idpoints = {}
     pointnum = {}
     skipped = {}
+    manifest_file = manifest_path(folder_name, point_end)
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+
     ids = sorted(os.listdir(folder_name))
+    subj_points = {subject: point_names(folder_name + subject) for subject in ids}
+    signatures = {}
+    stale = []
+    for subject in ids:
+        for subj_point in subj_points[subject]:
+            key = subject + "/" + subj_point
+            signatures[key] = _signature(folder_name + key, point_end, sampler)
+            if (key not in manifest or manifest[key]["signature"] != signatures[key]
+                    or manifest[key].get("sampler") != sampler):
+                stale.append(key)
+
+    missing = [folder_name + key for key in stale
+               if read_point(folder_name + key, sampler, point_end) is None]
+    if missing:
+        save_points(missing, point_end, model_gen, seed, processes=processes, cache=cache,
+                    sampler=sampler)
+    results = {}
+    unsolved = []
+    for key in stale:
+        with open(folder_name + key + point_end, "r") as f:
+            all_lines = f.readlines()
+        _, fail = read_point(folder_name + key, sampler, point_end)
+        perf = None
+        if len(all_lines) >= 3:
+            perf = "SKIP" if "SKIP" in all_lines[2] else float(all_lines[2])
+        else:
+            unsolved.append(key)
+        results[key] = (fail, perf, all_lines)
+    if unsolved:
+        with Pool(processes) as pool:
+            perfs = pool.map(_nominal_perf, [folder_name + key for key in unsolved])
+        for key, perf in zip(unsolved, perfs):
+            fail, _, all_lines = results[key]
+            _write_atomic(folder_name + key + point_end,
+                          "".join(all_lines).rstrip("\n") + "\n" + str(perf))
+            results[key] = (fail, perf, all_lines)
+    for key in stale:
+        fail, perf, _ = results[key]
+        signatures[key] = _signature(folder_name + key, point_end, sampler)
+        manifest[key] = {"signature": signatures[key], "fail": fail, "perf": perf,
+                         "sampler": sampler}
+    manifest = {key: manifest[key] for key in signatures}
+    if stale or len(manifest) != len(signatures):
+        _write_atomic(manifest_file, json.dumps(manifest))
+
     for subject in ids:
         idpoints[subject] = []
         skipped[subject] = []
-        subj_path = folder_name + subject
-        subj_points = sorted([x for x in os.listdir(subj_path)
-                         if not x.endswith(".txt")], key = int)
-        min_subj_point = int(subj_points[0])
-        for subj_point in subj_points:
-            perf = None
-            point_path = subj_path + "/" + subj_point
-            if os.path.isfile(point_path + point_end):
-                with open(point_path + point_end, "r") as f:
-                    all_lines = f.readlines()
-                    pf_line = all_lines[1]
-                    _, fail = [float(x) for x in pf_line.split(", ")]
-                    if len(all_lines) >= 3:
-                        perf = "SKIP" if "SKIP" in all_lines[2] else float(all_lines[2])
-            else:
-                _, fail = save_point(point_path, point_end=point_end, model_gen=model_gen, seed=seed)
-            if perf is None:
-                with open(point_path, "rb") as f:
-                    sol = pickle.load(f)
-                    nominal = SimPleAC(substitutions={k: sol(k) for k in ["S", "A", "V_{f_{avail}}", "C_L"]})
-                    try:
-                        nomsol = nominal.localsolve(verbosity=0)
-                        perf = nomsol("W_f").to("lbf").magnitude
-                    except Exception:
-                        perf = "SKIP"
-                with open(point_path + point_end, "a") as f:
-                    f.write("\n" + str(perf))
-            if perf != "SKIP" and perf != "SKIP\n":
+        min_subj_point = int(subj_points[subject][0])
+        for subj_point in subj_points[subject]:
+            entry = manifest[subject + "/" + subj_point]
+            perf, fail = entry["perf"], entry["fail"]
+            if perf != "SKIP":
                 if (perf, fail) in pointids:
                     if subject not in pointids[(perf, fail)]:
                         pointids[(perf, fail)].append(subject)
@@ -140,80 +347,104 @@ def corrected_points(folder_name, point_end="_point.txt", model_gen=SimPleAC, se
     return pointids, idpoints, pointnum, skipped
 
 
+def grid_indices(perf, fail, perf_width, fail_width, n_cols):
+    # the cells of int((perf-900)/perf_width)+1 clipped to the n_cols columns
+    # (column 0 and the last catch points off the fuel axis) and int(fail/fail_width)
+    perf, fail = np.asarray(perf, dtype=float), np.asarray(fail, dtype=float)
+    cols = np.clip(np.trunc((perf - 900)/perf_width).astype(int) + 1, 0, n_cols - 1)
+    rows = np.trunc(fail/fail_width).astype(int)
+    return rows, cols
+
+
+def regions_of(perf, fail):
+    # 0 green, 1 yellow, 2 blue, 3 outside
+    green = (perf <= 1200) & (fail <= 30)
+    yellow = ~green & (perf <= 2000) & (fail <= 10)
+    blue = ~green & ~yellow & (perf <= 1100)
+    return np.select([green, yellow, blue], [0, 1, 2], 3)
+
+
+def _point_columns(idpoints):
+    subjects = list(idpoints)
+    subj = np.repeat(np.arange(len(subjects)), [len(idpoints[s]) for s in subjects])
+    perf, fail = np.array([point for s in subjects for point in idpoints[s]],
+                          dtype=float).reshape(-1, 2).T
+    return subjects, subj, perf, fail
+
+
 def count_regions(idpoints):
-    regions = {}
-    numregions = {}
-    for idnum in idpoints:
-        regions[idnum] = 0
-        in_green = 0
-        in_yellow = 0
-        in_blue = 0
-        for point in idpoints[idnum]:
-            perf, fail = point
-            if (perf <= 1200 and fail <= 30):
-                in_green += 1
-            elif (perf <= 2000 and fail <= 10):
-                in_yellow += 1
-            elif (perf <= 1100):
-                in_blue += 1
-        if in_green>0:
-            regions[idnum] +=1
-        if in_yellow>0:
-            regions[idnum] +=1
-        if in_blue>0:
-            regions[idnum] +=1
-        numregions[idnum] = (in_green, in_yellow, in_blue)
+    subjects, subj, perf, fail = _point_columns(idpoints)
+    counts = np.bincount(subj*4 + regions_of(perf, fail),
+                         minlength=4*len(subjects)).reshape(-1, 4)
+    regions = {idnum: int(np.count_nonzero(counts[i, :3])) for i, idnum in enumerate(subjects)}
+    numregions = {idnum: tuple(int(c) for c in counts[i, :3]) for i, idnum in enumerate(subjects)}
     return regions, numregions
 
 
-def pareto(pointids):
-    pareto_points = {}
-    for point in pointids:
-        perf, fail = point
-        if (perf < 900 or perf > 2000):
-            continue
-        im_pareto = True
-        im_not_pareto = []
-        same = None
-        for pareto_point in pareto_points:
-            if (pareto_point[0] == perf and pareto_point[1] == fail):
-                pass
-            if (pareto_point[0] <= perf and pareto_point[1] <= fail):
-                im_pareto = False
-                break
-            elif (pareto_point[0] >= perf and pareto_point[1] >= fail):
-                im_not_pareto.append(pareto_point)
-        if im_pareto:
-            pareto_points[point] = pointids[point]
-            for not_pareto_point in im_not_pareto:
-                pareto_points.pop(not_pareto_point)
-    return pareto_points
+'''
+Per-subject statistics of one condition, in the subject order of idpoints: region
+counts (green, yellow, blue, outside), the time each region was first reached
+(NaN if never), the sorted point times and the number of 50 lbs by 10% cells
+covered within the fuel axis. Counts and cells come from idpoints, times from pointnum.
+'''
+def subject_stats(idpoints, pointnum):
+    subjects, subj, perf, fail = _point_columns(idpoints)
+    n = len(subjects)
+    counts = np.bincount(subj*4 + regions_of(perf, fail), minlength=4*n).reshape(-1, 4)
 
+    rows, cols = grid_indices(perf, fail, 50, 10, 23)
+    inside = (cols >= 1) & (cols <= 21)
+    cells = np.unique(((subj*11 + rows)*23 + cols)[inside])
+    grid_cover = np.bincount(cells//(11*23), minlength=n)
 
-def compare_pareto(pointids_condition):
-    pareto_points = {}
+    index = {idnum: i for i, idnum in enumerate(subjects)}
+    keys = list(pointnum)
+    t_subj = np.array([index[key[2]] for key in keys], dtype=int)
+    t_perf, t_fail = np.array([key[:2] for key in keys], dtype=float).reshape(-1, 2).T
+    t = np.array([int(pointnum[key]) for key in keys], dtype=float)
+    first = np.full((n, 4), np.inf)
+    np.minimum.at(first, (t_subj, regions_of(t_perf, t_fail)), t)
+    first[np.isinf(first)] = np.nan
+    order = np.lexsort((t, t_subj))
+    times = np.split(t[order].astype(int), np.cumsum(np.bincount(t_subj, minlength=n))[:-1])
+    return {"subjects": subjects, "counts": counts, "first": first[:, :3],
+            "times": times, "grid_cover": grid_cover}
+
+
+def pareto_mask(perf, fail):
+    # sorted by fuel (ties by failure), a point is on the front iff its failure
+    # rate is below every point before it; points are assumed distinct
+    perf, fail = np.asarray(perf, dtype=float), np.asarray(fail, dtype=float)
+    order = np.lexsort((fail, perf))
+    best_before = np.minimum.accumulate(np.concatenate([[np.inf], fail[order][:-1]]))
+    mask = np.zeros(len(perf), dtype=bool)
+    mask[order] = fail[order] < best_before
+    return mask
+
+
+def _front_points(points, perf_range):
+    points = [point for point in points if perf_range[0] <= point[0] <= perf_range[1]]
+    if not points:
+        return []
+    perf, fail = np.array(points, dtype=float).T
+    order = np.lexsort((fail, perf))
+    mask = pareto_mask(perf, fail)
+    return [points[i] for i in order if mask[i]]
+
+
+def pareto(pointids, perf_range=(900, 2000)):
+    return {point: pointids[point] for point in _front_points(list(pointids), perf_range)}
+
+
+def compare_pareto(pointids_condition, perf_range=(900, 2000)):
+    points = set()
     for condition in conditions:
-        for point in pointids_condition[condition]:
-            perf, fail = point
-            if (perf < 900 or perf > 2000):
-                continue
-            im_pareto = True
-            im_not_pareto = []
-            same = None
-            for pareto_point in pareto_points:
-                if (pareto_point[0] == perf and pareto_point[1] == fail):
-                    pass
-                elif (pareto_point[0] <= perf and pareto_point[1] <= fail):
-                    im_pareto = False
-                    break
-                elif (pareto_point[0] >= perf and pareto_point[1] >= fail):
-                    im_not_pareto.append(pareto_point)
-            if im_pareto:
-                if point in pareto_points:
-                    pareto_points[point].append((pointids_condition[condition][point], condition))
-                pareto_points[point] = [(pointids_condition[condition][point], condition)]
-                for not_pareto_point in im_not_pareto:
-                    pareto_points.pop(not_pareto_point)
+        points.update(pointids_condition[condition])
+    pareto_points = {}
+    for point in _front_points(list(points), perf_range):
+        pareto_points[point] = [(pointids_condition[condition][point], condition)
+                                for condition in conditions
+                                if point in pointids_condition[condition]]
     return pareto_points
 
 
@@ -326,10 +557,7 @@ def plot_compare_pareto():
             ),
     ))
     fig.update_shapes(dict(xref='x', yref='y'))
-    fig.show()
-    if not os.path.exists(analysis_plot_dir):
-        os.mkdir(analysis_plot_dir)
-    fig.write_image(analysis_plot_dir+title+".png")
+    output_figure(fig, title)
 
 
 def plot_points(points, title, colorfn=len, cmax=8):
@@ -412,19 +640,27 @@ def plot_points(points, title, colorfn=len, cmax=8):
             ),
     ))
     fig.update_shapes(dict(xref='x', yref='y'))
-    fig.show()
-    if not os.path.exists(analysis_plot_dir):
-        os.mkdir(analysis_plot_dir)
-    fig.write_image(analysis_plot_dir+title+".png")
+    output_figure(fig, title)
+
+
+def heatmap_frames(perf, fail, point_times, times):
+    # counts of the 51 x 112 heatmap cells (10 lbs by 2%) for the points before
+    # each of times, as one cumulative sum over the frame each point first shows in
+    rows, cols = grid_indices(perf, fail, 10, 2, 112)
+    first_frame = np.searchsorted(times, point_times, side="right")
+    counts = np.bincount(first_frame*51*112 + rows*112 + cols,
+                         minlength=(len(times) + 1)*51*112).reshape(-1, 51, 112)
+    return np.cumsum(counts, axis=0)[:len(times)]
+
+
+def heatmap_counts(perf, fail):
+    rows, cols = grid_indices(perf, fail, 10, 2, 112)
+    return np.bincount(rows*112 + cols, minlength=51*112).reshape(51, 112)
 
 
 def heatmap_points(points, title):
-    hmap = np.zeros((51, 112)) +.0001
-    for perf, fail in points:
-        i_col = min(max(int((perf-900)/10)+1, 0), 111)
-        i_row = int(fail/2)
-        hmap[i_row, i_col] += 1
-    hmap = np.log(hmap)
+    perf, fail = np.array(list(points), dtype=float).reshape(-1, 2).T
+    hmap = np.log(heatmap_counts(perf, fail) + .0001)
     ticks = np.round(np.logspace(np.log10(5),np.log10(80),5))
     x = [0] + list(np.linspace(900, 2000, 111)) + [6000]
     y = list(np.linspace(0, 100, 51))
@@ -457,10 +693,7 @@ def heatmap_points(points, title):
             range=[900,2000]
         )
     )
-    fig.show()
-    if not os.path.exists(analysis_plot_dir):
-        os.mkdir(analysis_plot_dir)
-    fig.write_image(analysis_plot_dir+title+".png")
+    output_figure(fig, title)
 
 
 def compensation(pareto_points, regions, idfile, outfile):
@@ -490,19 +723,18 @@ def compensation(pareto_points, regions, idfile, outfile):
 
 
 #TODO still uses uncorrected perf; but also don't need anymore
-def fragility(folder_name, title, model_gen=SimPleAC, seed=358):
+def fragility(folder_name, title, model_gen=SimPleAC, seed=358, cache=CACHE_PATH,
+              sampler=EXPERIMENT_SAMPLER):
     point_end = "_frag%i.txt" %seed
-    pointids, _, pointnum = get_points(folder_name, model_gen=model_gen)
-    fragpointids, _, _ = get_points(folder_name, point_end, model_gen, seed)
+    pointids, _, pointnum = get_points(folder_name, model_gen=model_gen, cache=cache, sampler=sampler)
+    fragpointids, _, _ = get_points(folder_name, point_end, model_gen, seed, cache, sampler=sampler)
     pps = pareto(pointids)
     fragpps = {}
     for pp in pps:
         for subject in pps[pp]:
             subj_point = pointnum[(pp, subject)]
             point_path = folder_name + subject + "/" + subj_point
-            with open(point_path + point_end, "r") as f:
-                pf_line = f.readlines()[1]
-                perf, fail = [float(x) for x in pf_line.split(", ")]
+            perf, fail = read_point(point_path, sampler, point_end)
             if (perf, fail) in fragpps:
                 if subject not in fragpps[(perf, fail)]:
                     fragpps[(perf, fail)].append(subject)
@@ -514,16 +746,103 @@ def fragility(folder_name, title, model_gen=SimPleAC, seed=358):
     heatmap_points(fragpointids, "Fragility Heatmap-" + title + " (seed %i)" %seed)
 
 
-def summary_stat_t_test(stat_conds, stat_name="stat"):
+def _welch(mean1, var1, n1, mean2, var2, n2):
+    se2 = var1/n1 + var2/n2
+    t = (mean1 - mean2)/np.sqrt(se2)
+    df = se2**2/((var1/n1)**2/(n1 - 1) + (var2/n2)**2/(n2 - 1))
+    return t, df
+
+
+def _holm(pvals):
+    order = np.argsort(pvals)
+    adjusted = np.empty(len(pvals))
+    adjusted[order] = np.minimum(np.maximum.accumulate(
+        (len(pvals) - np.arange(len(pvals)))*pvals[order]), 1)
+    return adjusted
+
+
+def _benjamini_hochberg(pvals):
+    order = np.argsort(pvals)
+    ranked = pvals[order]*len(pvals)/np.arange(1, len(pvals) + 1)
+    adjusted = np.empty(len(pvals))
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+def _permutation_p(task):
+    # two-sided p of |Welch t| over random relabelings of the pooled values
+    x, y, n_permutations, seed = task
+    rng = np.random.default_rng(seed)
+    pooled = np.concatenate([x, y])
+    perms = rng.permuted(np.tile(pooled, (n_permutations, 1)), axis=1)
+    a, b = perms[:, :len(x)], perms[:, len(x):]
+    t_obs, _ = _welch(np.mean(x), np.var(x, ddof=1), len(x), np.mean(y), np.var(y, ddof=1), len(y))
+    t_perm, _ = _welch(a.mean(axis=1), a.var(axis=1, ddof=1), len(x),
+                       b.mean(axis=1), b.var(axis=1, ddof=1), len(y))
+    return (1 + np.count_nonzero(np.abs(t_perm) >= abs(t_obs)))/(n_permutations + 1)
+
+
+'''
+Welch t-tests for every statistic of stat_table ({statistic: {condition: values}})
+and every pair of conditions at once, with Holm and Benjamini-Hochberg adjusted
+p-values over all the tests. With n_permutations, each test also gets a
+permutation p-value, run on processes workers from seed. sd is np.std (ddof=0).
+'''
+def summary_stat_tests(stat_table, n_permutations=0, processes=None, seed=0):
+    names = list(stat_table)
+    values = [[np.asarray(stat_table[name][condition], dtype=float) for condition in conditions]
+              for name in names]
+    if any(np.isnan(v).any() for row in values for v in row):
+        raise ValueError("The input contains nan values")
+    lengths = np.array([[len(v) for v in row] for row in values])
+    padded = np.full(lengths.shape + (max(lengths.max(), 1),), np.nan)
+    for i, row in enumerate(values):
+        for j, v in enumerate(row):
+            padded[i, j, :len(v)] = v
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.nanmean(padded, axis=2)
+        sds = np.nanstd(padded, axis=2)
+        variances = np.nanvar(padded, axis=2, ddof=1)
+        pairs = np.array(list(itertools.combinations(range(len(conditions)), 2)))
+        first, second = pairs[:, 0], pairs[:, 1]
+        t, df = _welch(means[:, first], variances[:, first], lengths[:, first],
+                       means[:, second], variances[:, second], lengths[:, second])
+        pvals = 2*stats.t.sf(np.abs(t), df)
+
+    rows = len(names)*len(pairs)
+    results = pd.DataFrame({
+        "statistic": np.repeat(names, len(pairs)),
+        "condition1": np.tile(np.array(conditions)[first], len(names)),
+        "condition2": np.tile(np.array(conditions)[second], len(names)),
+        "mean1": means[:, first].ravel(), "mean2": means[:, second].ravel(),
+        "sd1": sds[:, first].ravel(), "sd2": sds[:, second].ravel(),
+        "n1": lengths[:, first].ravel(), "n2": lengths[:, second].ravel(),
+        "t": t.ravel(), "df": df.ravel(), "p": pvals.ravel(),
+    }, index=range(rows))
+    tested = ~np.isnan(results["p"].values)
+    for column, correction in [("p_holm", _holm), ("p_bh", _benjamini_hochberg)]:
+        results[column] = np.nan
+        results.loc[tested, column] = correction(results["p"].values[tested])
+    if n_permutations:
+        seeds = np.random.SeedSequence(seed).spawn(rows)
+        tasks = [(values[i][a], values[i][b], n_permutations, seeds[i*len(pairs) + k])
+                 for i in range(len(names)) for k, (a, b) in enumerate(pairs)]
+        with Pool(processes) as pool:
+            results["p_permutation"] = pool.map(_permutation_p, tasks)
+    return results
+
+
+def summary_stat_t_test(stat_conds, stat_name="stat", results=None):
+    if results is None:
+        results = summary_stat_tests({stat_name: stat_conds})
     for condition in conditions:
         print(("%s %s" %(condition, stat_name)))
         print(list(stat_conds[condition]))
         print("Average: %f" %np.mean(stat_conds[condition]))
         print("StDev: %f" %np.std(stat_conds[condition]))
     print("T-Tests")
-    for condition1, condition2 in itertools.combinations(conditions, 2):
-        _, pval = stats.ttest_ind(stat_conds[condition1], stat_conds[condition2], equal_var=False, nan_policy='raise')
-        print("%s, %s p-value: %f" %(condition1, condition2, pval))
+    for row in results[results["statistic"] == stat_name].itertuples():
+        print("%s, %s p-value: %f" %(row.condition1, row.condition2, row.p))
 
 
 def plot_summary_stat(stat_conds, stat_name="stat"):
@@ -555,10 +874,7 @@ def plot_summary_stat(stat_conds, stat_name="stat"):
             gridcolor='rgba(0,0,0,.1)'
         )
     )
-    fig.show()
-    if not os.path.exists(analysis_plot_dir):
-        os.mkdir(analysis_plot_dir)
-    fig.write_image(analysis_plot_dir+stat_name+".png")
+    output_figure(fig, stat_name)
 
 
 def plot_delta_t(delta_t):
@@ -597,10 +913,7 @@ def plot_delta_t(delta_t):
             ),
             title=condition
         )
-        fig.show()
-        if not os.path.exists(analysis_plot_dir):
-            os.mkdir(analysis_plot_dir)
-        fig.write_image(analysis_plot_dir+condition+"_delta_t.png")
+        output_figure(fig, condition+"_delta_t")
         all_delta_t[condition] = avg_delta_t
 
     fig = go.Figure()
@@ -626,12 +939,20 @@ def plot_delta_t(delta_t):
         ),
         title="All Conditions"
     )
-    fig.show()
+    output_figure(fig)
+
 
+def condition_points(folder_name, from_store=False):
+    # (pointids, idpoints, pointnum) of a condition, from the point files with
+    # corrected fuel, or from_store the experiment table (see store_points)
+    if from_store:
+        return store_points(folder_name)
+    return corrected_points(folder_name)[:3]
 
-def all_analysis(folder_name, condition):
+
+def all_analysis(folder_name, condition, from_store=False):
     #pointids, idpoints, _ = get_points(folder_name)
-    pointids, idpoints, _, _ = corrected_points(folder_name)
+    pointids, idpoints, _ = condition_points(folder_name, from_store)
     pps = pareto(pointids)
     regions, _ = count_regions(idpoints)
     plot_points(pointids, "All Points-" + condition)
@@ -644,7 +965,7 @@ def all_analysis(folder_name, condition):
     # fragility(folder_name, condition, seed=839)
 
 
-def summary_stats():
+def summary_stats(n_permutations=0, processes=None, from_store=False):
     numpoints = {condition: [] for condition in conditions}
     numgreen = {condition: [] for condition in conditions}
     numyellow = {condition: [] for condition in conditions}
@@ -664,74 +985,68 @@ def summary_stats():
     delta_t = {condition: {} for condition in conditions}
     grid_cover = {condition: [] for condition in conditions}
     pointids_condition = {}
+    subjects_condition = {}
     for folder_name, condition in zip(folder_names, conditions):
-        pointids_condition[condition], idpoints, pointnum, skipped = corrected_points(folder_name)
+        pointids_condition[condition], idpoints, pointnum = condition_points(folder_name, from_store)
+        subjects_condition[condition] = sorted(idpoints)
         # pointids_condition[condition], idpoints, pointnum = get_points(folder_name)
-        numpoints[condition] = [len(idpoints[idnum]) for idnum in idpoints]
-        _, numregions = count_regions(idpoints)
+        subj_stats = subject_stats(idpoints, pointnum)
+        counts = subj_stats["counts"]
+        numpoints[condition] = list(counts.sum(axis=1))
         pps = pareto(pointids_condition[condition])
-        numgreen[condition], numyellow[condition], numblue[condition] = list(zip(*numregions.values()))
-        numout[condition] = np.subtract(np.subtract(np.subtract(numpoints[condition], numgreen[condition]), numyellow[condition]), numblue[condition])
+        numgreen[condition], numyellow[condition], numblue[condition] = counts[:, :3].T
+        numout[condition] = counts[:, 3]
         norm_numgreen[condition] = np.divide(numgreen[condition], numpoints[condition])
         norm_numyellow[condition] = np.divide(numyellow[condition], numpoints[condition])
         norm_numblue[condition] = np.divide(numblue[condition], numpoints[condition])
         norm_numout[condition] = np.divide(numout[condition], numpoints[condition])
         numpareto[condition] = [len([pp for pp in pps if idnum in pps[pp]]) for idnum in idpoints]
         norm_numpareto[condition] = np.divide(numpareto[condition], sum(numpareto[condition]))
-        times = {idnum: [] for idnum in idpoints}
-        timegreen = {idnum: None for idnum in idpoints}
-        timeyellow = {idnum: None for idnum in idpoints}
-        timeblue = {idnum: None for idnum in idpoints}
-        points = list(pointnum.keys())
-        points.sort(key = lambda x: int(pointnum[x]))
-        for point in points:
-            times[point[2]].append(int(pointnum[point]))
-            if (timegreen[point[2]] is None and (point[0] <= 1200 and point[1] <= 30)):
-                timegreen[point[2]] = int(pointnum[point])
-            elif (timeyellow[point[2]] is None and ((point[0] <= 2000 and point[0] > 1200) and point[1] <= 10)):
-                timeyellow[point[2]] = int(pointnum[point])
-            elif (timeblue[point[2]] is None and (point[0] <= 1100 and point[1] > 30)):
-                timeblue[point[2]] = int(pointnum[point])
-        timesgreen[condition] = [timegreen[idnum] - min(times[idnum]) for idnum in times if timegreen[idnum] is not None]
-        timesyellow[condition] = [timeyellow[idnum] - min(times[idnum]) for idnum in times if timeyellow[idnum] is not None]
-        timesblue[condition] = [timeblue[idnum] - min(times[idnum]) for idnum in times if timeblue[idnum] is not None]
-        endtimes[condition] = [max(times[idnum]) - min(times[idnum]) for idnum in times]
-        delta_t[condition] = {idnum: np.subtract(times[idnum][1:],times[idnum][:-1]) for idnum in times}
+        start = np.array([times[0] for times in subj_stats["times"]])
+        end = np.array([times[-1] for times in subj_stats["times"]])
+        first = subj_stats["first"] - start[:, None]
+        timesgreen[condition], timesyellow[condition], timesblue[condition] = \
+            [list(col[~np.isnan(col)].astype(int)) for col in first.T]
+        endtimes[condition] = list(end - start)
+        delta_t[condition] = {idnum: np.diff(times)
+                              for idnum, times in zip(subj_stats["subjects"], subj_stats["times"])}
         avg_delta_t[condition] = [item for sublist in delta_t[condition].values() for item in sublist]
-        for idnum in idpoints:
-            hmap = np.zeros((11, 23))
-            for perf, fail in idpoints[idnum]:
-                i_col = min(max(int((perf-900)/50)+1, 0), 22)
-                i_row = int(fail/10)
-                hmap[i_row, i_col] += 1
-            grid_cover[condition].append(np.count_nonzero(hmap[:, 1:22]))
+        grid_cover[condition] = list(subj_stats["grid_cover"])
 
     pareto_points = compare_pareto(pointids_condition)
-    id_pp = {condition: {idnum: 0 for idnum in sorted(os.listdir(folder_name))} for condition,folder_name in zip(conditions, folder_names)}
+    id_pp = {condition: {idnum: 0 for idnum in subjects_condition[condition]} for condition in conditions}
     for pp in pareto_points:
         for idnums in pareto_points[pp]:
             for idnum in idnums[0]:
                 id_pp[idnums[1]][idnum] += 1
     combined_pareto = {condition: list(id_pp[condition].values()) for condition in conditions}
 
-    summary_stat_t_test(numpoints, "Number of Points")
-    summary_stat_t_test(numgreen, "Number of Points in Green")
-    summary_stat_t_test(numyellow, "Number of Points in Yellow")
-    summary_stat_t_test(numblue, "Number of Points in Blue")
-    summary_stat_t_test(endtimes, "End Times")
-    summary_stat_t_test(norm_numgreen, "Normalized Number of Points in Green")
-    summary_stat_t_test(norm_numyellow, "Normalized Number of Points in Yellow")
-    summary_stat_t_test(norm_numblue, "Normalized Number of Points in Blue")
-    summary_stat_t_test(numout, "Number of Points Outside")
-    summary_stat_t_test(norm_numout, "Normalized Number of Points Outside")
-    summary_stat_t_test(timesgreen, "Time to first Green Point")
-    summary_stat_t_test(timesyellow, "Time to first Yellow Point")
-    summary_stat_t_test(timesblue, "Time to first Blue Point")
-    summary_stat_t_test(numpareto, "Number of Points on Pareto")
-    summary_stat_t_test(norm_numpareto, "Percent of Points on Pareto")
-    summary_stat_t_test(combined_pareto, "Number of Points on Combined Pareto")
-    summary_stat_t_test(avg_delta_t, "Delta T")
-    summary_stat_t_test(grid_cover, "Grid Points Covered")
+    stat_table = {
+        "Number of Points": numpoints,
+        "Number of Points in Green": numgreen,
+        "Number of Points in Yellow": numyellow,
+        "Number of Points in Blue": numblue,
+        "End Times": endtimes,
+        "Normalized Number of Points in Green": norm_numgreen,
+        "Normalized Number of Points in Yellow": norm_numyellow,
+        "Normalized Number of Points in Blue": norm_numblue,
+        "Number of Points Outside": numout,
+        "Normalized Number of Points Outside": norm_numout,
+        "Time to first Green Point": timesgreen,
+        "Time to first Yellow Point": timesyellow,
+        "Time to first Blue Point": timesblue,
+        "Number of Points on Pareto": numpareto,
+        "Percent of Points on Pareto": norm_numpareto,
+        "Number of Points on Combined Pareto": combined_pareto,
+        "Delta T": avg_delta_t,
+        "Grid Points Covered": grid_cover,
+    }
+    results = summary_stat_tests(stat_table, n_permutations, processes)
+    for stat_name, stat_conds in stat_table.items():
+        summary_stat_t_test(stat_conds, stat_name, results)
+    if not os.path.exists(analysis_plot_dir):
+        os.mkdir(analysis_plot_dir)
+    results.to_csv(analysis_plot_dir + "summary_tests.csv", index=False)
 
     plot_summary_stat(numpoints, "Number of Points")
     plot_summary_stat(numgreen, "Number of Points in Green")
@@ -756,9 +1071,13 @@ def summary_stats():
 
 
 if __name__ == "__main__":
-    
+    report["enabled"] = "--report" in sys.argv
+
     for folder_name, condition in zip(folder_names, conditions):
         all_analysis(folder_name, condition)
 
     summary_stats()
 
+    if report["enabled"]:
+        export_report()
+
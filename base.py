@@ -1,12 +1,23 @@
 from IPython.display import display
 import ipywidgets as widgets
 from simpleac import SimPleAC
-from monte_carlo import monte_carlo_results
+from robust_model import robust_model
+from monte_carlo import monte_carlo_results, EXPERIMENT_SAMPLER
+from mc_cache import MCCache, CACHE_PATH
+from surrogate import load_surrogate
+from frontier import gamma_frontier, cached_frontier, remember_frontier
+from store import append_point, session_path, save_snapshot, results_line
+from pareto_front import ParetoFront
 import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from collections import OrderedDict
+import threading
 import plotly.graph_objects as go
 import pickle
 import os
 import csv
+import numpy as np
 
 TUTORIAL = "tutorial"
 CONTROL = "control"
@@ -14,14 +25,115 @@ MARGIN = "margin"
 ROBUST_PERFORMANCE = "robust_performance"
 ROBUST_GAMMA = "robust_gamma"
 
+class SolutionStore(object):
+    '''
+    Solution of the last committed click of a widget session (never a speculative
+    one), shared between the kernel thread and the background executor.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sol = None
+
+    def get(self):
+        with self.lock:
+            return self.sol
+
+    def put(self, sol):
+        with self.lock:
+            self.sol = sol
+
+
+def warm_localsolve(m, store):
+    last = store.get()
+    if last is not None:
+        # the model is rebuilt every click, so match the last solution by name
+        previous = {k.name: v for k, v in last["freevariables"].items()}
+        x0 = {var: previous[var.name] for var in m.varkeys
+              if var.name in previous and var not in m.substitutions}
+        try:
+            return m.localsolve(verbosity=0, x0=x0)
+        except Exception:
+            # the warm start can land somewhere the SP iterations diverge
+            # from, so fall back to a cold start before calling it infeasible
+            pass
+    return m.localsolve(verbosity=0)
+
+
+'''
+Constructor for the ROBUST_GAMMA and ROBUST_PERFORMANCE conditions, whose first lever
+is the performance (lbs) or Gamma slider and the rest the four uncertainty percentages.
+The constructor takes the lever values read when the click (or prefetch) happened.
+The nominal solve and RobustModel are built once per set of percentages (keeping the
+maxsize most recently used), and only the performance or Gamma substitution is
+updated before each robustsolve.
+'''
+def robust_model_gen(condition, maxsize=8):
+    cache = OrderedDict()
+    lock = threading.Lock()
+
+    def constructor(values):
+        target = values[0]
+        prs = tuple(values[1:])
+        with lock:
+            if prs in cache:
+                cache.move_to_end(prs)
+            else:
+                cache[prs] = robust_model(prs, bound_performance=condition == ROBUST_GAMMA)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            rm, target_var = cache[prs]
+            rm.substitutions[target_var] = target if condition == ROBUST_GAMMA else target/3.0
+        return rm
+    return constructor
+
+
 '''
 subs - function that generates substitutions based on the lever widgets
-model_gen - function that generates model
+model_gen - function that generates model (for the robust conditions, from the lever
+            values; see robust_model_gen)
+processes - number of worker processes for the Monte Carlo (serial if None)
+mc_tol - if given, stop the Monte Carlo once the failure rate is known to within
+         this many percent (see monte_carlo_results)
+mc_method - how the Monte Carlo evaluates each sample (see monte_carlo_results)
+mc_sampler - how the Monte Carlo draws its samples (see monte_carlo.SAMPLERS); it is
+             recorded with each point's results, and the analysis reads results of
+             EXPERIMENT_SAMPLER
+mc_cache - path of the Monte Carlo results cache shared across sessions (None to disable)
+background - run each simulation on a background thread so the widget stays
+             responsive; a new click supersedes a job still queued or running
+prefetch - while the levers sit still for prefetch_delay seconds, solve that position
+           in the background so a click on it shows without waiting (needs background);
+           up to prefetch_size speculative results are kept for the session
+surrogate - a Surrogate (or the path of a saved one), only for CONTROL or MARGIN; each new
+            click first shows its estimate, and the true result then refines it
+warm_start - start each CONTROL/MARGIN localsolve from the last converged solution; off
+             by default, as a position can then converge to a different local optimum
+             depending on the clicks before it, which the experiments were not run with
+frontier - for ROBUST_GAMMA, build the Gamma-vs-performance frontier of each set of
+           percentages in a separate background process, and print the frontier's Gamma
+           as a first estimate on later clicks (each click is still solved in full)
+show_front - draw the session's current Pareto front of fuel against failure rate
 '''
-def setup(levers, subs, model_gen, condition, exp=True):
+def setup(levers, subs, model_gen, condition, exp=True, processes=None, mc_tol=None,
+          mc_method="solve", mc_sampler=EXPERIMENT_SAMPLER, mc_cache=CACHE_PATH,
+          background=True, prefetch=False, prefetch_delay=1.0, prefetch_size=20,
+          surrogate=None, warm_start=False, frontier=False, show_front=False):
     start_time = time.time()
+    store = SolutionStore()
+    if surrogate is not None and condition not in [CONTROL, MARGIN]:
+        # its levers are the design (or the margins), not the robust percentages
+        raise ValueError("A surrogate is only for the %s and %s conditions, not %s"
+                         % (CONTROL, MARGIN, condition))
+    if isinstance(surrogate, str):
+        surrogate = load_surrogate(surrogate)
+    if surrogate is not None and surrogate.condition != condition:
+        # a margin surrogate would read the design levers as margins, and vice versa
+        raise ValueError("Surrogate built for %s, not %s" % (surrogate.condition, condition))
+    cache = MCCache(mc_cache) if mc_cache else None
     global path
     path = "data/%s/%.0f/" % (condition, start_time)
+    # this session's own table, so that kernels never write to the same file
+    table = session_path("data/%s/" % condition, "%.0f_%i" % (start_time, os.getpid()))
 
     button = widgets.Button(description="Run Simulation")
 
@@ -113,6 +225,10 @@ def setup(levers, subs, model_gen, condition, exp=True):
     ))
     fig.update_shapes(dict(xref='x', yref='y'))
     fig.add_trace(go.Scatter(mode='lines+markers'))
+    front = ParetoFront()
+    if show_front:
+        fig.add_trace(go.Scatter(mode='lines', line_shape='hv', hoverinfo='skip',
+                                 line={"color": 'rgba(255, 68, 170, 0.5)', "dash": 'dash'}))
     diagram = go.FigureWidget();
     diagram.add_scatter(line={"color": "black"});
     diagram.update_layout(
@@ -189,119 +305,301 @@ def setup(levers, subs, model_gen, condition, exp=True):
     iconds = []
     times = []
 
+    executor = ThreadPoolExecutor(max_workers=1)
+    jobs = {"latest": None, "cond": None}
+    # a frontier sweep takes many robust solves, so it never queues ahead of a click;
+    # gpkit's variable naming is process-wide, so sweeps get their own process
+    # (spawned, as forking next to the executor thread is unsafe)
+    frontier_executor = (ProcessPoolExecutor(max_workers=1,
+                                             mp_context=multiprocessing.get_context("spawn"))
+                         if frontier and condition == ROBUST_GAMMA else None)
+    frontier_jobs = {}
+
+    def frontier_done(future):
+        # the sweep cached its frontier in the worker; keep a copy here
+        if not future.cancelled() and future.exception() is None:
+            remember_frontier(future.result())
+
+    def subject():
+        # the session folder, renamed once the subject ID is entered
+        return os.path.basename(os.path.normpath(path))
+
+    def show(output, text):
+        # callable from the executor thread, unlike `with output:`
+        output.append_stdout(text + "\n")
+
+    def record(point_time, status, cond, sol=None, performance=np.nan, failure=np.nan,
+               interval=None):
+        # a failed write to the table is reported, and does not stop the click
+        if not exp:
+            return
+        try:
+            append_point(table, subject(), point_time, status, cond, sol, performance, failure,
+                         mc_sampler if status in ["point", "repeat"] else "", interval)
+        except Exception as e:
+            show(out, "Point not recorded in the table: %s" % e)
+
+    def solve(substitutions, values, track=True):
+        # values are the lever values when the job was submitted, not when it runs
+        if track:
+            progress.description = 'Loading:'
+        if condition in [ROBUST_GAMMA, ROBUST_PERFORMANCE]:
+            m = model_gen(values)
+        else:
+            m = model_gen()
+        m.substitutions.update(substitutions)
+        try:
+            if condition in [CONTROL, MARGIN]:
+                if warm_start:
+                    sol = warm_localsolve(m, store)
+                else:
+                    sol = m.localsolve(verbosity = 0)
+            elif condition == TUTORIAL:
+                sol = m.solve(verbosity = 0)
+            else:
+                sol = m.robustsolve(verbosity=0)
+                m = SimPleAC()
+        except Exception as e:
+            return None, e, None
+
+        if condition == TUTORIAL:
+            results = (sol("C_o").magnitude, sol("F_a").magnitude)
+        else:
+            progress.value = 0
+            results = monte_carlo_results(m, progress if track else None, sol=sol, quiet=True,
+                                          processes=processes, tol=mc_tol,
+                                          method=mc_method, cache=cache, sampler=mc_sampler)
+        return sol, None, results
+
+    def commit(cond, point_time, sol, error, results, values=None, current=True):
+        # a superseded click's result is recorded and plotted, but the output and
+        # the diagram belong to the later click
+        def tell(text):
+            if current:
+                show(out, text)
+
+        if current:
+            progress.layout.visibility = 'hidden'
+        if warm_start and sol is not None and condition in [CONTROL, MARGIN]:
+            store.put(sol)
+            # finished prefetches started from the previous click's solution, and
+            # would give a click a result this session's warm starts would not
+            with speculation["lock"]:
+                for done in [k for k, f in speculation["futures"].items() if f.done()]:
+                    del speculation["futures"][done]
+        if surrogate is not None and values is not None:
+            surrogate.add(values, *(results[:2] if sol is not None else (np.nan, np.nan)))
+        if sol is None:
+            tell("Infeasible Conditions")
+            show(ifeas, cond)
+            iconds.append(cond)
+            filename = path + "%.0f_infeas" % point_time + ".txt"
+            f = open(filename, "w+")
+            f.write(str(cond) +"\n")
+            f.write(str(error))
+            f.close()
+            record(point_time, "infeas", cond)
+            return
+
+        if current and condition == TUTORIAL:
+            size = (sol("S_a").magnitude)/2
+            diagram.data[0].x, diagram.data[0].y = draw_diagram(16*size, 
+                                                                23*size, 
+                                                                0.6*size)
+        elif current:
+            sol_wing_area = sol("S").magnitude
+            sol_wing_length = ((sol("A").magnitude)*float(sol_wing_area))**.5
+            sol_fuel = sol("V_f_fuse").magnitude
+            diagram.data[0].x, diagram.data[0].y = draw_diagram(sol_wing_length, 
+                                                                sol_wing_area, 
+                                                                sol_fuel)
+        if exp:
+            filename = path + "%.0f" % point_time
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            sol.save(filename)
+            if condition != TUTORIAL:
+                save_snapshot(filename, sol)
+
+        performance, failure = results[:2]
+        # an early-stopped estimate is kept with its interval, samples and tolerance
+        interval = ((results[2] + (results[3], mc_tol))
+                    if len(results) > 2 and results[2] is not None else None)
+        tell("Fuel consumption: %i lbs" % performance)
+        tell("    Failure rate: % 2.1f%% " % failure)
+        if len(results) > 2:
+            tell("    (%2.1f%% to %2.1f%%, %i samples)" % (results[2] + results[3:]))
+
+        if exp:
+            filename = path + "%.0f_point" % point_time + ".txt"
+            f = open(filename, "w+")
+            f.write(str(cond) +"\n")
+            f.write(results_line(performance, failure, mc_sampler, interval))
+            f.close()
+
+        if performance:
+            x.append(performance)
+            y.append(failure)
+            conds.append(cond)
+            times.append(point_time)
+            fig.data[0].x = x
+            fig.data[0].y = y
+            fig.data[0].hovertext = conds
+            fig.data[0].marker=dict(
+                size=[7]*(len(times) - 2) + [12, 18][:len(times)],
+                showscale=False,
+                color=["#aa44ff"]*(len(times) - 2) + ["#dd44cc", "#ff44aa"][:len(times)],
+            )
+            fig.data[0].line={
+                "color":'rgba(170, 68, 255, 0.2)'
+            }
+            if front.insert(performance, failure, cond) and show_front:
+                fig.data[1].x = front.perfs
+                fig.data[1].y = front.fails
+        record(point_time, "point", cond, sol, performance, failure, interval)
+
+    def superseded(cond, point_time):
+        # every click is recorded, even one whose job never ran
+        if exp:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            f = open(path + "%.0f_superseded" % point_time + ".txt", "w+")
+            f.write(str(cond))
+            f.close()
+        record(point_time, "superseded", cond)
+
+    def repeat(cond, point_time, current=True):
+        # a click on an already tested position
+        if current:
+            show(out, cond + " already tested")
+        if cond in iconds:
+            if current:
+                show(out, "Infeasible Conditions")
+            filename = path + "%.0f_repeat_infeas" % point_time + ".txt"
+            f = open(filename, "w+")
+            f.write(str(cond))
+            f.close()
+            record(point_time, "repeat_infeas", cond)
+        else:
+            i = conds.index(cond)
+            if current:
+                show(out, "Fuel consumption: %i lbs" % x[i])
+                show(out, "    Failure rate: % 2.1f%% " % y[i])
+            filename = path + "%.0f_repeat" % point_time + ".txt"
+            f = open(filename, "w+")
+            f.write(str(cond) +"\n")
+            f.write(results_line(x[i], y[i], mc_sampler))
+            f.close()
+            record(point_time, "repeat", cond, performance=x[i], failure=y[i])
+
+    def finish(future, cond, point_time, values):
+        # a job superseded by a later click is still committed if it completed
+        current = future is jobs["latest"]
+        if future.cancelled():
+            superseded(cond, point_time)
+            return
+        try:
+            commit(cond, point_time, *future.result(), values=values, current=current)
+        except Exception as e:
+            if current:
+                progress.layout.visibility = 'hidden'
+            show(out, "Error: %s" % e)
+
+    def repeated(future, cond, point_time):
+        # a second click on the position being solved, once that job is committed
+        if cond in iconds or cond in conds:
+            repeat(cond, point_time, current=False)
+        else:
+            superseded(cond, point_time)
+
     def on_button_clicked(b):
-        m = model_gen()
-        m.substitutions.update(subs(levers))
-        cond = str([lever.value for lever in levers])
-        out.clear_output()
+        values = [lever.value for lever in levers]
+        cond = str(values)
+        latest = jobs["latest"]
         point_time = time.time()-start_time
-        
-        if cond in iconds:
-            with out:
-                print(cond + " already tested")
-                print("Infeasible Conditions")
-                filename = path + "%.0f_repeat_infeas" % point_time + ".txt"
-                f = open(filename, "w+")
-                f.write(str(cond))
-                f.close()
-
-        elif cond in conds:
-            with out:
-                print(cond + " already tested")
-                i = conds.index(cond)
-                print("Fuel consumption: %i lbs" % x[i])
-                print("    Failure rate: % 2.1f%% " % y[i])
-                filename = path + "%.0f_repeat" % point_time + ".txt"
-                f = open(filename, "w+")
-                f.write(str(cond) +"\n")
-                f.write(str(x[i]) + ", " + str(y[i]))
-                f.close()
-        
+        if latest is not None and not latest.done() and jobs["cond"] == cond:
+            latest.add_done_callback(lambda f: repeated(f, cond, point_time))
+            return
+        out.clear_output()
+
+        if cond in iconds or cond in conds:
+            repeat(cond, point_time)
+
         else:
             with out:
                 print(cond)
+                if surrogate is not None:
+                    estimate = surrogate.predict(values)
+                    if estimate is None:
+                        print("Estimate: likely infeasible")
+                    else:
+                        print("Estimate: %i lbs (+/- %i), % 2.1f%% (+/- %2.1f%%)"
+                              % (estimate[0], estimate[2], estimate[1], estimate[3]))
+                if frontier and condition == ROBUST_GAMMA:
+                    known = cached_frontier(values[1:])
+                    if known is not None:
+                        gamma = known.gamma_at(values[0])
+                        if gamma is None and values[0] < known.performances[0]:
+                            print("Frontier: below the nominal design's fuel")
+                        elif gamma is None:
+                            print("Frontier: above the largest Gamma swept")
+                        else:
+                            print("Frontier: Gamma %.3f" % gamma)
+            if not background:
+                commit(cond, point_time, *solve(subs(levers), values), values=values)
+                return
+            if latest is not None:
+                latest.cancel()
+            with speculation["lock"]:
+                future = speculation["futures"].pop(cond, None)
+                # speculative jobs for other positions only get in the way now
+                for stale in speculation["futures"].values():
+                    stale.cancel()
+            progress.description = 'Queued:'
+            progress.value = 0
+            progress.layout.visibility = None
+            if future is None or future.cancelled():
+                future = executor.submit(solve, subs(levers), values)
+            jobs["latest"], jobs["cond"] = future, cond
+            future.add_done_callback(lambda f: finish(f, cond, point_time, values))
+            if frontier and condition == ROBUST_GAMMA:
+                prs = tuple(values[1:])
+                # sweeps still waiting for other percentages are no longer wanted
+                for other in list(frontier_jobs):
+                    if frontier_jobs[other].done() or (other != prs and frontier_jobs[other].cancel()):
+                        del frontier_jobs[other]
+                if cached_frontier(prs) is None and prs not in frontier_jobs:
+                    frontier_jobs[prs] = frontier_executor.submit(gamma_frontier, prs)
+                    frontier_jobs[prs].add_done_callback(frontier_done)
+    button.on_click(on_button_clicked)
 
-            try:
-                if condition in [CONTROL, MARGIN]:
-                    sol = m.localsolve(verbosity = 0)
-                    sol_wing_area = sol("S").magnitude
-                    sol_wing_length = ((sol("A").magnitude)*float(sol_wing_area))**.5
-                    sol_fuel = sol("V_f_fuse").magnitude
-                    diagram.data[0].x, diagram.data[0].y = draw_diagram(sol_wing_length, 
-                                                                        sol_wing_area, 
-                                                                        sol_fuel)
-                elif condition == TUTORIAL:
-                    sol = m.solve(verbosity = 0)
-                    size = (sol("S_a").magnitude)/2
-                    diagram.data[0].x, diagram.data[0].y = draw_diagram(16*size, 
-                                                                        23*size, 
-                                                                        0.6*size)
-                else:
-                    sol = m.robustsolve(verbosity=0)
-                    m = SimPleAC()
-                    sol_wing_area = sol("S").magnitude
-                    sol_wing_length = ((sol("A").magnitude)*float(sol_wing_area))**.5
-                    sol_fuel = sol("V_f_fuse").magnitude
-                    diagram.data[0].x, diagram.data[0].y = draw_diagram(sol_wing_length, 
-                                                                        sol_wing_area, 
-                                                                        sol_fuel)
-                if exp:
-                    filename = path + "%.0f" % point_time
-                    if not os.path.isdir(path):
-                        os.makedirs(path)
-                    sol.save(filename)
-
-            except Exception as e:
-                with out:
-                    print("Infeasible Conditions")
-                with ifeas:
-                    print(cond)
-                iconds.append(cond)
-                filename = path + "%.0f_infeas" % point_time + ".txt"
-                f = open(filename, "w+")
-                f.write(str(cond) +"\n")
-                f.write(str(e))
-                f.close()
+    speculation = {"lock": threading.Lock(), "futures": OrderedDict(), "timer": None}
+
+    def speculate():
+        values = [lever.value for lever in levers]
+        cond = str(values)
+        latest = jobs["latest"]
+        if (cond in conds or cond in iconds
+                or (latest is not None and not latest.done() and jobs["cond"] == cond)):
+            return
+        with speculation["lock"]:
+            futures = speculation["futures"]
+            if cond in futures and not futures[cond].cancelled():
                 return
+            futures[cond] = executor.submit(solve, subs(levers), values, False)
+            while len(futures) > prefetch_size:
+                futures.popitem(last=False)[1].cancel()
 
-            
-            if condition == TUTORIAL:
-                performance = sol("C_o").magnitude
-                failure = sol("F_a").magnitude
-                with out:
-                    print("Fuel consumption: %i lbs" % performance)
-                    print("    Failure rate: % 2.1f%% " % failure)
-            else:
-                progress.value = 0
-                progress.layout.visibility = None
-                performance, failure = monte_carlo_results(m, progress, out, sol=sol)
-
-            if exp:
-                filename = path + "%.0f_point" % point_time + ".txt"
-                f = open(filename, "w+")
-                f.write(str(cond) +"\n")
-                f.write(str(performance)+", "+str(failure))
-                f.close()
-
-            if performance:
-                x.append(performance)
-                y.append(failure)
-                conds.append(cond)
-                times.append(point_time)
-                fig.data[0].x = x
-                fig.data[0].y = y
-                fig.data[0].hovertext = conds
-                import numpy as np
-                fig.data[0].marker=dict(
-                    size=[7]*(len(times) - 2) + [12, 18][:len(times)],
-                    showscale=False,
-                    color=["#aa44ff"]*(len(times) - 2) + ["#dd44cc", "#ff44aa"][:len(times)],
-                )
-                fig.data[0].line={
-                    "color":'rgba(170, 68, 255, 0.2)'
-                }
-        progress.layout.visibility = 'hidden'
-    button.on_click(on_button_clicked)
+    def on_lever_change(change):
+        # debounced: only speculate once the levers have been still for a moment
+        if speculation["timer"] is not None:
+            speculation["timer"].cancel()
+        speculation["timer"] = threading.Timer(prefetch_delay, speculate)
+        speculation["timer"].start()
+
+    if prefetch and background:
+        for lever in levers:
+            lever.observe(on_lever_change, names='value')
 
     col1 = widgets.VBox(levers_text + [button, fig, progress, out])
     
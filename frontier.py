@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from robust_model import robust_model
+
+_frontiers = OrderedDict()
+_lock = threading.Lock()
+
+
+class GammaFrontier(object):
+    '''
+    Largest Gamma that still meets a fuel budget, as a function of that budget,
+    for one set of uncertainty percentages. performances is nondecreasing in gammas.
+    bounded is set if the sweep found where Gamma goes infeasible, so that the last
+    of gammas is the largest feasible Gamma at any budget.
+    '''
+    def __init__(self, prs, gammas, performances, sols, bounded=False):
+        self.prs = prs
+        self.bounded = bounded
+        self.gammas = np.array(gammas, dtype=float)
+        # solver noise aside, more Gamma never needs less fuel
+        self.performances = np.maximum.accumulate(np.array(performances, dtype=float))
+        self.sols = sols
+
+    def gamma_at(self, performance):
+        # None where even the nominal (Gamma=0) design needs more fuel
+        if not len(self.performances) or performance < self.performances[0]:
+            return None
+        # and above the last point, unless no Gamma past it is feasible
+        if performance > self.performances[-1] and not self.bounded:
+            return None
+        return float(np.interp(performance, self.performances, self.gammas))
+
+    def sol_at(self, performance):
+        # the solved point of the frontier closest below the budget
+        i = np.searchsorted(self.performances, performance, side="right") - 1
+        return self.sols[i] if i >= 0 else None
+
+
+def _gamma_solver(prs):
+    rm, gamma = robust_model(prs)
+
+    def solve(value):
+        rm.substitutions[gamma] = value
+        try:
+            return rm.robustsolve(verbosity=0)
+        except Exception:
+            return None
+    return solve
+
+
+'''
+Sweeps Gamma over gammas with one robust reformulation (fuel minimized at each
+fixed Gamma), doubling past the last of gammas until a Gamma is infeasible or
+max_gamma is reached, then bisects between neighbouring Gammas until the fuel they need
+differs by at most perf_tol lbs, and between the last feasible and first
+infeasible Gamma until they are gamma_tol apart. Frontiers are kept for the
+maxsize most recently used sets of percentages.
+'''
+def gamma_frontier(prs, gammas=np.linspace(0, 2, 21), perf_tol=10., gamma_tol=1e-3,
+                   max_gamma=1e3, max_solves=200, maxsize=16):
+    prs = tuple(prs)
+    with _lock:
+        if prs in _frontiers:
+            _frontiers.move_to_end(prs)
+            return _frontiers[prs]
+
+    solve = _gamma_solver(prs)
+    points = {}
+    for gamma in gammas:
+        points[gamma] = solve(gamma)
+        if points[gamma] is None:
+            break
+    n_solves = len(points)
+    gamma = max(points)
+    while points[gamma] is not None and 0 < gamma < max_gamma and n_solves < max_solves:
+        gamma = min(2*gamma, max_gamma)
+        points[gamma] = solve(gamma)
+        n_solves += 1
+
+    def perf(sol):
+        return sol("W_f").to("lbf").magnitude
+
+    refined = True
+    while refined and n_solves < max_solves:
+        refined = False
+        ordered = sorted(points)
+        for lo, hi in zip(ordered[:-1], ordered[1:]):
+            if points[lo] is None:
+                break
+            if points[hi] is None:
+                split = hi - lo > gamma_tol
+            else:
+                split = perf(points[hi]) - perf(points[lo]) > perf_tol and hi - lo > gamma_tol
+            if split and n_solves < max_solves:
+                mid = 0.5*(lo + hi)
+                points[mid] = solve(mid)
+                n_solves += 1
+                refined = True
+
+    feasible = []
+    for gamma in sorted(points):
+        if points[gamma] is None:
+            break
+        feasible.append(gamma)
+    # the largest feasible Gamma is only known once a larger one failed
+    bounded = len(feasible) < len(points)
+    frontier = GammaFrontier(prs, feasible, [perf(points[g]) for g in feasible],
+                             [points[g] for g in feasible], bounded)
+    remember_frontier(frontier, maxsize)
+    return frontier
+
+
+def remember_frontier(frontier, maxsize=16):
+    # also how a frontier swept in another process is cached in this one
+    with _lock:
+        _frontiers[frontier.prs] = frontier
+        _frontiers.move_to_end(frontier.prs)
+        while len(_frontiers) > maxsize:
+            _frontiers.popitem(last=False)
+
+
+def cached_frontier(prs):
+    with _lock:
+        return _frontiers.get(tuple(prs))
@@ -0,0 +1,49 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+CACHE_PATH = "data/mc_cache.sqlite"
+
+
+class MCCache(object):
+    '''
+    Disk-backed cache of Monte Carlo results, keyed by monte_carlo.cache_key.
+    Every read refreshes an entry's last use, and once there are more than
+    max_entries results the least recently used ones are evicted.
+    '''
+    def __init__(self, path=CACHE_PATH, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(key TEXT PRIMARY KEY, result TEXT, last_used REAL)")
+
+    def _connect(self):
+        # one connection per operation, so the cache can be shared across
+        # threads, processes and notebook kernels
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT result FROM results WHERE key = ?",
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?",
+                         (time.time(), key))
+        return tuple(tuple(x) if isinstance(x, list) else x
+                     for x in json.loads(row[0]))
+
+    def put(self, key, result):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                         (key, json.dumps(result), time.time()))
+            excess = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM results WHERE key IN "
+                             "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                             (excess,))
@@ -1,126 +1,450 @@
+import hashlib
+import os
+from multiprocessing import Pool
 import numpy as np
 import scipy.stats as stats
-from gpkit import ureg, NamedVariables
+from gpkit import NamedVariables
 from simpleac import SimPleAC
 
 m = SimPleAC()
 N = 100
+MARGINS = ["m_ww", "m_tsfc", "m_vmin", "m_range"]
+BANK_DIR = "data/banks/"
+N_BANK = 1000
+# how samples are drawn: from a perturbation_bank, or the original global-RNG draws
+SAMPLERS = ["bank", "legacy"]
+# what base.setup records points with and the analysis reads them with, so that
+# recorded results are the ones analysed; all points before banks were legacy
+EXPERIMENT_SAMPLER = "legacy"
 
+_worker_model = None
+_worker_design = None
+_batch_args = None
 
-def monte_carlo_results(m, progress=None, out=None, sol=None, quiet=False, seed=246):
+
+'''
+Memory-mapped (n x n_uncertain) bank of unit truncated-normal draws for seed,
+generated once with its own Generator and kept as an .npy under bank_dir.
+'''
+def perturbation_bank(seed, n_uncertain, n=N_BANK, bank_dir=BANK_DIR):
+    path = bank_dir + "bank_%i_%i_%i.npy" % (seed, n, n_uncertain)
+    if not os.path.isfile(path):
+        bank = stats.truncnorm.rvs(-3, 3, size=(n, n_uncertain),
+                                   random_state=np.random.default_rng(seed))
+        os.makedirs(bank_dir, exist_ok=True)
+        # written under a temporary name so concurrent workers never see half a bank
+        tmp_path = path[:-len(".npy")] + "_%i.tmp.npy" % os.getpid()
+        np.save(tmp_path, bank)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def draw_samples(m, seed, n=N, sampler="bank"):
+    if sampler == "legacy":
+        # the draws every point was scored with before perturbation banks
+        np.random.seed(seed)
+        return [{k.name: stats.truncnorm.rvs(-3, 3, loc=1, scale=k.key.orig_pr/300.)
+                 for k in m.substitutions if k.pr} for _ in range(n)]
+    if sampler != "bank":
+        raise ValueError("Unknown sampler %s, expected one of %s" % (sampler, SAMPLERS))
+    uncertain = sorted((k for k in m.substitutions if k.pr), key=lambda k: k.name)
+    bank = perturbation_bank(seed, len(uncertain), max(n, N_BANK))
+    scale = np.array([k.key.orig_pr/300. for k in uncertain])
+    names = [k.name for k in uncertain]
+    return [dict(zip(names, row)) for row in 1 + bank[:n]*scale]
+
+
+def fuel_weight(sol):
+    # lbs of fuel of a solution, or of a store.Snapshot (which keeps W_f in lbs)
+    value = sol("W_f")
+    return float(value.to("lbf").magnitude) if hasattr(value, "to") else float(value)
+
+
+def fixed_values(m, sol):
+    return {var.name: sol["variables"][var.name]
+            for var in m.varkeys if var.fix}
+
+
+def fix_design(m, fixed):
+    for var in m.varkeys:
+        if var.fix:
+            m.substitutions[var] = fixed[var.name]
+        if var.margin:
+            m.substitutions[var] = 1
+    m.pop()
+
+
+def sample_fails(m, subs):
+    m.substitutions.update(subs)
+    try:
+        m.solve(verbosity=0)
+    except Exception:
+        return True
+    return False
+
+
+class CompiledModel(object):
+    '''
+    Stand-in for a fixed, popped model that compiles it into a GeometricProgram
+    once. Only the margin substitutions change between samples, so solve() just
+    rescales the coefficients of the monomials the margins appear in and calls
+    the solver on the already-built program.
+    '''
+    def __init__(self, m):
+        self.margins = [var for var in m.varkeys if var.margin]
+        self.substitutions = {}
+        self.gp = m.gp()
+        self.cs = np.array(self.gp.cs)
+        # exponent of each margin in each monomial, read off by recompiling
+        # with that margin set to e (substitutions do not reorder monomials)
+        self.exps = np.zeros((len(self.cs), len(self.margins)))
+        for j, var in enumerate(self.margins):
+            value = m.substitutions[var]
+            m.substitutions[var] = np.e
+            self.exps[:, j] = np.log(np.array(m.gp().cs)/self.cs)
+            m.substitutions[var] = value
+
+    def solve(self, verbosity=0):
+        values = np.array([self.substitutions.get(var.name, 1.) for var in self.margins])
+        self.gp.cs = self.cs * np.exp(self.exps.dot(np.log(values)))
+        # raises on anything but an optimal solve, which is all we need
+        return self.gp.solve(verbosity=verbosity, gen_result=False)
+
+
+def _init_worker(model_gen, fixed, method):
+    # each worker builds and pops its own copy of the fixed design once
+    global _worker_model
     NamedVariables.reset_modelnumbers()
-    np.random.seed(seed=seed)
-    monte_up = [{k.name: stats.truncnorm.rvs(-3, 3, loc=1,
-                                             scale=(k.key.orig_pr/300.))
-                 for k in m.substitutions if k.pr}
-                for _ in range(N)]
+    _worker_model = model_gen()
+    fix_design(_worker_model, fixed)
+    if method == "compiled":
+        _worker_model = CompiledModel(_worker_model)
+
+
+def _worker_sample_fails(subs):
+    return sample_fails(_worker_model, subs)
+
+
+def cache_key(m, sol, seed, n, sampler="bank", **options):
+    design = sorted((name, float(value)) for name, value in fixed_values(m, sol).items())
+    margins = sorted((var.name, float(sol["variables"][var.name]))
+                     for var in m.varkeys if var.margin)
+    prs = sorted((k.name, k.pr, k.key.orig_pr) for k in m.substitutions if k.pr)
+    # the two samplers draw different samples for the same seed
+    key = repr((design, margins, prs, seed, n, sampler, sorted(options.items())))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _report(message, out, quiet):
+    if out:
+        with out:
+            print(message)
+    elif not quiet:
+        print(message)
+
+
+def failure_interval(failures, n, interval="wilson", confidence=0.95):
+    alpha = 1 - confidence
+    if interval == "wilson":
+        z = stats.norm.ppf(1 - alpha/2)
+        p = failures/float(n)
+        center = (p + z**2/(2*n))/(1 + z**2/n)
+        half = z/(1 + z**2/n) * (p*(1 - p)/n + z**2/(4*n**2))**0.5
+        return (max(center - half, 0.), min(center + half, 1.))
+    elif interval == "clopper-pearson":
+        lo = 0. if failures == 0 else stats.beta.ppf(alpha/2, failures, n - failures + 1)
+        hi = 1. if failures == n else stats.beta.ppf(1 - alpha/2, failures + 1, n - failures)
+        return (lo, hi)
+    raise ValueError("Unknown interval %s" % interval)
+
+
+def _sample_verdicts(m, sol, samples, method, pool):
+    if method == "analytic":
+        for failed in does_it_fail(sol, samples):
+            yield failed
+    elif pool:
+        # the verdicts (and their count) do not depend on the order
+        # in which workers return them
+        for failed in pool.imap_unordered(_worker_sample_fails, samples):
+            yield failed
+    else:
+        for subs in samples:
+            yield sample_fails(m, subs)
+
+
+'''
+processes - if given, spread the samples over a pool of that many worker processes,
+            each of which rebuilds the fixed design once from model_gen
+model_gen - function that generates the model in each worker (defaults to the class of m)
+method - "solve" to GP-solve every sample, "compiled" to do so on a GP compiled
+         once per design (see CompiledModel), "analytic" to use does_it_fail
+cross_check - with method="analytic", also GP-solve this many samples and
+              report how many verdicts disagree
+tol - if given, sample in batches of batch until the half-width of the failure
+      rate interval (in percent) is below tol, or max_N samples have been used;
+      the interval and the number of samples are then returned as well
+interval - "wilson" or "clopper-pearson"
+cache - an MCCache to look results up in and store them to
+sampler - one of SAMPLERS; results of different samplers differ for the same seed
+'''
+def monte_carlo_results(m, progress=None, out=None, sol=None, quiet=False, seed=246,
+                        processes=None, model_gen=None, method="solve", cross_check=0,
+                        tol=None, batch=20, max_N=1000, interval="wilson", cache=None,
+                        sampler="bank"):
+    NamedVariables.reset_modelnumbers()
+    n_draws = max_N if tol else N
+    monte_up = draw_samples(m, seed, n_draws, sampler)
     try:
         if sol is None:
             sol = m.localsolve(verbosity=0)
-        if out:
-            with out:
-                print("Fuel consumption: %i lbs" % sol("W_f").to("lbf").magnitude)
-        elif not quiet:
-            print("Fuel consumption: %i lbs" % sol("W_f").to("lbf").magnitude)
+        _report("Fuel consumption: %i lbs" % fuel_weight(sol), out, quiet)
     except Exception:
-        return (None, None)
+        return (None, None, None, 0) if tol else (None, None)
     else:
+        if cache:
+            # "solve" and "compiled" give the same verdicts, "analytic" may not
+            options = {"analytic": method == "analytic"}
+            if tol:
+                options.update(tol=tol, batch=batch, interval=interval)
+            key = cache_key(m, sol, seed, n_draws, sampler, **options)
+            results = cache.get(key)
+            if results:
+                _report("    Failure rate: % 2.1f%% " % results[1], out, quiet)
+                if tol:
+                    _report("    (%2.1f%% to %2.1f%%, %i samples)"
+                            % (results[2] + results[3:]), out, quiet)
+                return results
         failures = 0
-        for var in m.varkeys:
-            if var.fix:
-                m.substitutions[var] = sol["variables"][var.name]
-            if var.margin:
-                m.substitutions[var] = 1
-        m.pop()
-        for i, subs in enumerate(monte_up):
-            m.substitutions.update(subs)
-            try:
-                # assert not does_it_fail(sol, W_W_coeff1)
-                # UNCOMMENT THE ABOVE AND COMMENT OUT THE BELOW TO SPEED UP
-                m.solve(verbosity=0)
-            except Exception:
-                failures += 1
-            if progress:
-                progress.value = i/N
-        if out:
-            with out:
-                print("    Failure rate: % 2.1f%% " % (100*failures/float(N)))
-        elif not quiet:
-            print("    Failure rate: % 2.1f%% " % (100*failures/float(N)))
-        return (sol("W_f").to("lbf").magnitude, 100*failures/float(N))
-
-
-def does_it_fail(sol, W_W_coeff1):
-    W_W_coeff1 *= ureg("1/m")
-
-    W_W_coeff2 = sol("W_W_coeff2")
-    tau = sol("tau")
-    N_ult = sol("N_ult")
-    W_0 = sol("W_0")
-    V_f_fuse = sol("V_f_fuse")
-    g = sol("g")
-    e = sol("e")
-    k = sol("k")
-    S_wetratio = sol("S_wetratio")
-    rho_f = sol("rho_f")
-    rho = sol("rho")
-    mu = sol("mu")
-    TSFC = sol("TSFC")
-    Range = sol("Range")
-    C_Lmax = sol("C_Lmax")
-    V_min = sol("V_{min}")
-
-    # free variable
-    A = sol("A")
-    S = sol("S")
-    V_f_fuse = sol("V_f_fuse")
-    C_L = sol("C_L")
-
-    # iterate
-    V_cruisemax = sol("V")
-    W = W_orig = sol("W")
-    V_cruisemax_prev = W_prev = 0
-
-    # kinda changed
-    W_f = sol("W_f")
-
-    while abs((W - W_prev).magnitude) >= 0.1:
-        W_w_surf = W_W_coeff2 * S
-        W_w_strc = ((W_W_coeff1**2 / tau**2
-                     * (N_ult**2 * A**3
-                        * ((W_0+V_f_fuse*g*rho_f) * W * S))))**0.5
-        W_w = W_w_surf + W_w_strc
-        W_prev = W
-        W = W_0 + W_w + W_f
-
-    # so the above is for fully-loaded, but,
-    # we may not be able to lift off with a full fuel load
-
-    if (0.5 * rho * S * C_Lmax * V_min ** 2 < W - W_f):
-        # cannot take off with any fuel!
-        return True
+        n = 0
+        fixed = fixed_values(m, sol)
+        pool = None
+        if method != "analytic":
+            if processes:
+                if model_gen is None:
+                    model_gen = type(m)
+                pool = Pool(processes, _init_worker, (model_gen, fixed, method))
+            else:
+                fix_design(m, fixed)
+                if method == "compiled":
+                    m = CompiledModel(m)
+        try:
+            step = batch if tol else N
+            for start in range(0, n_draws, step):
+                samples = monte_up[start:start+step]
+                for failed in _sample_verdicts(m, sol, samples, method, pool):
+                    failures += failed
+                    n += 1
+                    if progress:
+                        progress.value = n/float(n_draws)
+                if tol:
+                    lo, hi = failure_interval(failures, n, interval)
+                    if 100*(hi - lo)/2. <= tol:
+                        break
+        finally:
+            if pool:
+                pool.terminate()
+        if method == "analytic" and cross_check:
+            verdicts = does_it_fail(sol, monte_up[:cross_check])
+            fix_design(m, fixed)
+            mismatches = 0
+            for i, subs in enumerate(monte_up[:cross_check]):
+                mismatches += sample_fails(m, subs) != verdicts[i]
+            _report("    Analytic/GP disagreement: %i of %i samples"
+                    % (mismatches, len(verdicts)), out, quiet)
+        _report("    Failure rate: % 2.1f%% " % (100*failures/float(n)), out, quiet)
+        results = (fuel_weight(sol), 100*failures/float(n))
+        if tol:
+            lo, hi = failure_interval(failures, n, interval)
+            _report("    (%2.1f%% to %2.1f%%, %i samples)" % (100*lo, 100*hi, n), out, quiet)
+            results += ((100*lo, 100*hi), n)
+        if cache:
+            cache.put(key, results)
+        return results
 
-    # full or partial fuel
-    W_f = min(0.5 * rho * S * C_Lmax * V_min ** 2 - (W-W_f), W_f)
 
-    V_f = W_f / g / rho_f
-    V_f_wing = (0.0009*S**3/A*tau**2)**0.5
-    V_f_avail = V_f_wing + V_f_fuse
+def _init_batch_worker(model_gen, designs, samples, method):
+    global _batch_args, _worker_design
+    _batch_args = (model_gen, designs, samples, method)
+    _worker_design = None
 
-    CDA0 = V_f_fuse/(10*ureg('m'))
-    C_D_fuse = CDA0 / S
 
-    while (V_cruisemax - V_cruisemax_prev).magnitude >= 0.1:
-        Re = (rho / mu) * V_cruisemax * (S / A) ** 0.5
-        C_f = 0.074 / Re ** 0.2
-        C_D_wpar = k * C_f * S_wetratio
+def _batch_failures(task):
+    # a worker only rebuilds and fixes the model when a task is for a new design;
+    # tasks are whole designs unless there are fewer designs than processes
+    global _worker_model, _worker_design
+    d, start, stop = task
+    model_gen, designs, samples, method = _batch_args
+    if _worker_design != d:
+        NamedVariables.reset_modelnumbers()
+        _worker_model = model_gen()
+        fix_design(_worker_model, designs[d])
+        if method == "compiled":
+            _worker_model = CompiledModel(_worker_model)
+        _worker_design = d
+    return d, sum(sample_fails(_worker_model, subs) for subs in samples[start:stop])
+
 
-        C_D_ind = C_L ** 2 / (np.pi * A * e)
-        C_D = C_D_fuse + C_D_wpar + C_D_ind
+'''
+Scores many designs (solutions) against one shared set of N samples, returning a
+structured array of (perf, fail) with one row per design. With processes, each
+design is one task on a single pool, so each design's model is built once; only
+when there are fewer designs than processes are designs split into sample ranges
+(of at least min_chunk samples) to keep every process busy. sampler is as in
+monte_carlo_results.
+'''
+def monte_carlo_batch(designs, seed=246, N=N, model_gen=SimPleAC, processes=None,
+                      method="solve", min_chunk=25, cache=None, sampler="bank"):
+    NamedVariables.reset_modelnumbers()
+    m = model_gen()
+    samples = draw_samples(m, seed, N, sampler)
+    results = np.zeros(len(designs), dtype=[("perf", float), ("fail", float)])
+    failures = np.zeros(len(designs))
+    keys = [None]*len(designs)
+    todo = []
+    for d, sol in enumerate(designs):
+        results["perf"][d] = fuel_weight(sol)
+        if cache:
+            keys[d] = cache_key(m, sol, seed, N, sampler, analytic=method == "analytic")
+            cached = cache.get(keys[d])
+            if cached:
+                results["fail"][d] = cached[1]
+                continue
+        todo.append(d)
+    fixed = [fixed_values(m, designs[d]) for d in todo]
+
+    if method == "analytic":
+        for d in todo:
+            failures[d] = does_it_fail(designs[d], samples).sum()
+    elif processes:
+        splits = min(-(-processes // max(len(todo), 1)), max(N // min_chunk, 1))
+        chunk = -(-N // splits)
+        tasks = [(i, start, min(start + chunk, N))
+                 for i in range(len(todo)) for start in range(0, N, chunk)]
+        with Pool(processes, _init_batch_worker,
+                  (model_gen, fixed, samples, method)) as pool:
+            for i, count in pool.imap_unordered(_batch_failures, tasks):
+                failures[todo[i]] += count
+    else:
+        _init_batch_worker(model_gen, fixed, samples, method)
+        for i in range(len(todo)):
+            failures[todo[i]] = _batch_failures((i, 0, N))[1]
 
-        V_cruisemax_prev = V_cruisemax
-        V_cruisemax = 1/(TSFC * Range * 0.5 * rho * S * C_D / W_f)
-    V_cruisemin = ((W_0 + W_w + 0.5 * W_f)/(0.5 * rho * S * C_L))**0.5
+    for d in todo:
+        results["fail"][d] = 100*failures[d]/float(N)
+        if cache:
+            cache.put(keys[d], (float(results["perf"][d]), float(results["fail"][d])))
+    return results
 
-    if (V_cruisemin > V_cruisemax):
-        return True
+
+# everything does_it_fail reads from a solution, and the units it works in
+ANALYTIC_INPUTS = {
+    "g": "m/s^2", "mu": "kg/m/s", "rho": "kg/m^3", "rho_f": "kg/m^3",
+    "C_Lmax": "dimensionless", "e": "dimensionless", "k": "dimensionless",
+    "N_ult": "dimensionless", "S_wetratio": "dimensionless", "tau": "dimensionless",
+    "W_W_coeff1": "1/m", "W_W_coeff2": "Pa", "Range": "m", "TSFC": "1/s",
+    "V_{min}": "m/s", "W_0": "N",
+    # fixed design
+    "A": "dimensionless", "S": "m^2", "C_L": "dimensionless",
+    "V_{f_{avail}}": "m^3", "V_f_fuse": "m^3",
+}
+
+
+def _si(sol, name, unit="dimensionless"):
+    value = sol(name)
+    if hasattr(value, "to"):
+        value = value.to(unit).magnitude
+    return float(value)
+
+
+def analytic_inputs(sol):
+    # a store.Snapshot already keeps these in ANALYTIC_INPUTS units
+    return {name: _si(sol, name, unit) for name, unit in ANALYTIC_INPUTS.items()}
+
+
+def _weight(W_f, m_ww, W_0, W_w_surf, W_w_strc_coeff, tol=0.1):
+    # lightest aircraft that carries W_f: W = W_0 + W_w(W) + W_f
+    W = W_0 + W_f
+    W_prev = np.zeros_like(W)
+    active = np.ones(W.shape, dtype=bool)
+    while active.any():
+        W_w = m_ww[active] * (W_w_surf + (W_w_strc_coeff * W[active])**0.5)
+        W_prev[active] = W[active]
+        W[active] = W_0 + W_w + W_f[active]
+        active &= np.abs(W - W_prev) >= tol
+    return W
+
+
+'''
+Closed-form feasibility check of the fixed design in sol for every sample in
+monte_up at once; returns a boolean array (True where the sample fails).
+
+Starting from no fuel, the fuel needed to fly the (margined) range at the
+slowest cruise speed that still holds the aircraft up is iterated to its
+smallest fixed point. The sample fails as soon as that fuel no longer fits in
+V_f_avail or the loaded aircraft can no longer take off.
+'''
+def does_it_fail(sol, monte_up, tol=0.1, max_iter=1000):
+    margins = {name: np.array([subs.get(name, 1.) for subs in monte_up], dtype=float)
+               for name in MARGINS}
+    m_ww = margins["m_ww"]
+    m_tsfc = margins["m_tsfc"]
+    m_vmin = margins["m_vmin"]
+    m_range = margins["m_range"]
+
+    # units removed up front; everything below is SI
+    si = analytic_inputs(sol)
+    g = si["g"]
+    mu = si["mu"]
+    rho = si["rho"]
+    rho_f = si["rho_f"]
+    C_Lmax = si["C_Lmax"]
+    e = si["e"]
+    k = si["k"]
+    N_ult = si["N_ult"]
+    S_wetratio = si["S_wetratio"]
+    tau = si["tau"]
+    W_W_coeff1 = si["W_W_coeff1"]
+    W_W_coeff2 = si["W_W_coeff2"]
+    Range = si["Range"]
+    TSFC = si["TSFC"]
+    V_min = si["V_{min}"]
+    W_0 = si["W_0"]
+
+    # fixed design
+    A = si["A"]
+    S = si["S"]
+    C_L = si["C_L"]
+    V_f_avail = si["V_{f_{avail}}"]
+    V_f_fuse = si["V_f_fuse"]
+
+    W_w_surf = W_W_coeff2 * S
+    W_w_strc_coeff = (W_W_coeff1**2 / tau**2
+                      * N_ult**2 * A**3 * (W_0 + V_f_fuse*g*rho_f) * S)
+    W_takeoff = 0.5 * rho * S * C_Lmax * (V_min / m_vmin)**2
+    W_f_avail = V_f_avail * g * rho_f
+    C_D_fuse = V_f_fuse / 10. / S
+    C_D_ind = C_L**2 / (np.pi * A * e)
+    fuel_per_drag = TSFC * m_tsfc * Range * m_range * 0.5 * rho * S
+
+    W_f = np.zeros(len(monte_up))
+    failed = np.zeros(len(monte_up), dtype=bool)
+    active = np.ones(len(monte_up), dtype=bool)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        W = _weight(W_f[active], m_ww[active], W_0, W_w_surf, W_w_strc_coeff, tol)
+        W_w = W - W_0 - W_f[active]
+        V_cruisemin = ((W_0 + W_w + 0.5 * W_f[active])/(0.5 * rho * S * C_L))**0.5
+
+        Re = (rho / mu) * V_cruisemin * (S / A) ** 0.5
+        C_f = 0.074 / Re ** 0.2
+        C_D = C_D_fuse + k * C_f * S_wetratio + C_D_ind
+        W_f_needed = fuel_per_drag[active] * C_D * V_cruisemin
+
+        # both W and W_f_needed only grow from here on
+        fails = (W > W_takeoff[active]) | (W_f_needed > W_f_avail)
+        converged = np.abs(W_f_needed - W_f[active]) < tol
+        W_f[active] = W_f_needed
+        failed[active] = fails
+        active[active] = ~(fails | converged)
+    return failed
@@ -0,0 +1,33 @@
+import bisect
+
+
+class ParetoFront(object):
+    '''
+    Live (fuel, failure rate) front of a session, kept sorted by fuel (and so by
+    decreasing failure rate). Each point carries the labels of the clicks that
+    reached it.
+    '''
+    def __init__(self):
+        self.perfs = []
+        self.fails = []
+        self.labels = []
+
+    def insert(self, perf, fail, label=None):
+        # True if the point is on the front afterwards
+        i = bisect.bisect_right(self.perfs, perf)
+        if i and self.perfs[i-1] == perf and self.fails[i-1] == fail:
+            self.labels[i-1].append(label)
+            return True
+        if i and self.fails[i-1] <= fail:
+            return False
+        lo = bisect.bisect_left(self.perfs, perf)
+        hi = lo
+        while hi < len(self.fails) and self.fails[hi] >= fail:
+            hi += 1
+        self.perfs[lo:hi] = [perf]
+        self.fails[lo:hi] = [fail]
+        self.labels[lo:hi] = [[label]]
+        return True
+
+    def points(self):
+        return dict(zip(zip(self.perfs, self.fails), self.labels))
@@ -0,0 +1,26 @@
+from gpkit import Variable
+from simpleac import SimPleAC
+
+
+'''
+Nominal solve and box-uncertainty RobustModel of SimPleAC for one set of uncertainty
+percentages, with Gamma as a variable. With bound_performance, fuel is bounded by a
+'performance' variable and Gamma maximized; otherwise fuel is minimized at a given
+Gamma. Returns the model and the variable to substitute (performance or Gamma).
+'''
+def robust_model(prs, bound_performance=False):
+    # robust is only needed (and only imported) by the robust conditions
+    from robust.robust import RobustModel
+    m = SimPleAC(*prs)
+    nominal_sol = m.localsolve(verbosity=0)
+    gamma = Variable('Gamma', '-', 'Uncertainty bound')
+    target_var = gamma
+    if bound_performance:
+        target_var = Variable('performance', 'lbf', 'Fuel consumption bound')
+        m.append(m["W_f"] <= target_var)
+        m.append(gamma <= 1e30)
+        m.cost = 1/gamma
+    rm = RobustModel(m, "box", gamma=gamma,
+                     twoTerm=False, boyd=False, simpleModel=True,
+                     nominalsolve=nominal_sol)
+    return rm, target_var
@@ -34,5 +34,5 @@ setup(name='robust_experiment',
       license=license,,
       packages=[],
       install_requires=['robust', 'gpkit', 'gplibrary', 'numpy', 'matplotlib',
-                        'scipy', 'plotly', 'plotly-orca', 'pandas', 'ipywidgets',
+                        'scipy', 'plotly', 'plotly-orca', 'pandas', 'tables', 'ipywidgets',
                         'voila', 'jupyter'])
@@ -0,0 +1,335 @@
+import ast
+import json
+import os
+import pickle
+import threading
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import monte_carlo
+from monte_carlo import fuel_weight, fixed_values, analytic_inputs
+from simpleac import SimPleAC
+
+KEY = "points"
+MAX_LEVERS = 5
+LEVERS = ["lever_%i" % i for i in range(MAX_LEVERS)]
+# solved variable -> column
+SOLVED = {"S": "S", "A": "A", "V_{f_{avail}}": "V_f_avail", "C_L": "C_L",
+          "V_f_fuse": "V_f_fuse", "m_ww": "m_ww", "m_tsfc": "m_tsfc",
+          "m_vmin": "m_vmin", "m_range": "m_range", "W_f": "W_f"}
+# results of a Monte Carlo stopped early (mc_tol): failure rate interval (in percent),
+# samples used and the tolerance; NaN for the full N samples
+INTERVAL = ["failure_lo", "failure_hi", "samples", "mc_tol"]
+COLUMNS = (["subject", "time", "status", "cond"] + LEVERS + list(SOLVED.values())
+           + ["performance", "failure", "sampler"] + INTERVAL)
+# superseded: clicked, but a later click came before its job ran
+STATUSES = ["point", "repeat", "infeas", "repeat_infeas", "superseded"]
+# strings in an appendable table need a fixed width
+ITEMSIZES = {"subject": 64, "status": 16, "cond": 160, "sampler": 16}
+
+SNAPSHOT_END = "_snap.json"
+# snapshots of older versions are ignored in favour of the pickle
+SNAPSHOT_VERSION = 2
+
+_lock = threading.Lock()
+
+
+def store_path(folder_name):
+    # "./data/control/" -> "./data/control_store/", holding one table per session
+    return folder_name.rstrip("/") + "_store/"
+
+
+def session_path(folder_name, session):
+    # each session only ever appends to its own file, so no two processes share one
+    return store_path(folder_name) + "%s.h5" % session
+
+
+def recorded_sessions(folder_name):
+    # start times of the sessions that wrote their own table ("<start>_<pid>.h5")
+    if not os.path.isdir(store_path(folder_name)):
+        return set()
+    return {x.split("_")[0] for x in os.listdir(store_path(folder_name))
+            if x.endswith(".h5") and x.split("_")[0].isdigit()}
+
+
+def lever_values(cond):
+    values = [np.nan]*MAX_LEVERS
+    try:
+        parsed = ast.literal_eval(cond.strip())
+    except (ValueError, SyntaxError):
+        return values
+    if isinstance(parsed, (list, tuple)):
+        for i, value in enumerate(parsed[:MAX_LEVERS]):
+            values[i] = float(value)
+    return values
+
+
+def results_line(perf, fail, sampler, interval=None):
+    # the second line of a _point.txt (or _repeat.txt) file; interval is the
+    # (lo, hi, samples, tol) of a Monte Carlo stopped early (see INTERVAL)
+    line = "%s, %s, %s" % (perf, fail, sampler)
+    if interval is not None:
+        line += ", %s, %s, %s, %s" % tuple(interval)
+    return line
+
+
+def read_interval(line):
+    # (lo, hi, samples, tol) of a results line, NaN if it used the full N samples
+    fields = line.split(",")
+    if len(fields) < 3 + len(INTERVAL):
+        return (np.nan,)*len(INTERVAL)
+    return tuple(float(x) for x in fields[3:3 + len(INTERVAL)])
+
+
+def read_results(line):
+    # (perf, fail, sampler) of a results line; lines without a sampler predate
+    # perturbation banks, so were drawn with the legacy sampler
+    fields = [x.strip() for x in line.split(",")]
+    sampler = fields[2] if len(fields) > 2 else "legacy"
+    return float(fields[0]), float(fields[1]), sampler
+
+
+def _value(sol, name):
+    value = sol(name)
+    return float(getattr(value, "magnitude", value))
+
+
+def solved_values(sol):
+    values = {}
+    for var, column in SOLVED.items():
+        try:
+            # W_f in lbs, whether sol is a solution or a Snapshot
+            values[column] = fuel_weight(sol) if var == "W_f" else _value(sol, var)
+        except Exception:
+            values[column] = np.nan
+    return values
+
+
+def point_names(subj_path):
+    # the point pickles of a subject folder, in click order
+    return sorted([x for x in os.listdir(subj_path) if x.isdigit()], key=int)
+
+
+class Snapshot(dict):
+    '''
+    What analysis and the Monte Carlo read from a point, without the rest of the
+    SolutionArray: the fixed design and margins (sol["variables"][name], in the
+    variables' units), W_f in lbs (see monte_carlo.fuel_weight) and the inputs
+    of monte_carlo.does_it_fail in its units. sol(name) reads either.
+    '''
+    def __call__(self, name):
+        if name in self["analytic"]:
+            return self["analytic"][name]
+        return self["variables"][name]
+
+
+def _margins(m, sol):
+    return {var.name: float(sol["variables"][var.name]) for var in m.varkeys if var.margin}
+
+
+def check_snapshot(sol, snapshot):
+    # everything the Monte Carlo scores a point on must match the solution
+    m = monte_carlo.m
+    pairs = [(fixed_values(m, sol), fixed_values(m, snapshot)),
+             (_margins(m, sol), _margins(m, snapshot)),
+             ({"W_f": fuel_weight(sol)}, {"W_f": fuel_weight(snapshot)})]
+    if snapshot["analytic"]:
+        pairs.append((analytic_inputs(sol), analytic_inputs(snapshot)))
+    for expected, found in pairs:
+        for name in expected:
+            if not np.isclose(float(expected[name]), float(found[name]), rtol=1e-12):
+                raise ValueError("Snapshot differs from its solution in %s" % name)
+
+
+def save_snapshot(point_path, sol):
+    m = monte_carlo.m
+    variables = {name: float(value) for name, value in fixed_values(m, sol).items()}
+    variables.update(_margins(m, sol))
+    variables["W_f"] = fuel_weight(sol)
+    try:
+        analytic = analytic_inputs(sol)
+    except Exception:
+        # only needed for method="analytic"
+        analytic = {}
+    cost = sol["cost"]
+    snapshot = Snapshot(version=SNAPSHOT_VERSION, variables=variables, analytic=analytic,
+                        cost=float(getattr(cost, "magnitude", cost)))
+    check_snapshot(sol, snapshot)
+    tmp = point_path + SNAPSHOT_END + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, point_path + SNAPSHOT_END)
+    return snapshot
+
+
+def _snapshot(point_path):
+    # the point's snapshot, unless it has none or an outdated one
+    if os.path.isfile(point_path + SNAPSHOT_END):
+        with open(point_path + SNAPSHOT_END, "r") as f:
+            snapshot = Snapshot(json.load(f))
+        if snapshot.get("version") == SNAPSHOT_VERSION:
+            return snapshot
+    return None
+
+
+def load_solution(point_path):
+    # the point's snapshot if it has a current one, else its full pickle
+    snapshot = _snapshot(point_path)
+    if snapshot is not None:
+        return snapshot
+    with open(point_path, "rb") as f:
+        return pickle.load(f)
+
+
+'''
+Scores a point from its snapshot and from its pickle with the same samples and
+raises if the two (perf, fail) results differ.
+'''
+def check_snapshot_scores(point_path, seed=246, method="solve"):
+    with open(point_path, "rb") as f:
+        sol = pickle.load(f)
+    snapshot = _snapshot(point_path)
+    if snapshot is None:
+        raise ValueError("%s has no current snapshot" % point_path)
+    scores = [monte_carlo.monte_carlo_results(SimPleAC(), sol=solution, quiet=True,
+                                              seed=seed, method=method)
+              for solution in [sol, snapshot]]
+    if scores[0] != scores[1]:
+        raise ValueError("%s scores %s from its pickle but %s from its snapshot"
+                         % (point_path, scores[0], scores[1]))
+    return scores[0]
+
+
+def variable_values(sol, names):
+    return [_value(sol, name) for name in names]
+
+
+def _migrate(point_path):
+    with open(point_path, "rb") as f:
+        sol = pickle.load(f)
+    check_snapshot(sol, save_snapshot(point_path, sol))
+    # and once more as read back from disk
+    check_snapshot(sol, load_solution(point_path))
+
+
+'''
+One-shot extraction of snapshots from the point pickles of a data/<condition>/
+tree that do not have a current one yet, unpickling on processes workers. Each
+snapshot is checked to give the Monte Carlo the same design, margins, fuel and
+analytic inputs as its pickle.
+'''
+def migrate_snapshots(folder_name, processes=None):
+    point_paths = []
+    for subject in sorted(os.listdir(folder_name)):
+        subj_path = folder_name + subject + "/"
+        if os.path.isdir(subj_path):
+            point_paths.extend(subj_path + x for x in point_names(subj_path)
+                               if _snapshot(subj_path + x) is None)
+    if point_paths:
+        with Pool(processes) as pool:
+            pool.map(_migrate, point_paths, chunksize=16)
+    return len(point_paths)
+
+
+def point_row(subject, time, status, cond, sol=None, performance=np.nan, failure=np.nan,
+              sampler="", interval=None):
+    row = {"subject": subject, "time": float(time), "status": status, "cond": str(cond),
+           "sampler": sampler}
+    row.update(zip(LEVERS, lever_values(str(cond))))
+    row.update(solved_values(sol) if sol is not None
+               else {column: np.nan for column in SOLVED.values()})
+    row["performance"] = float(performance)
+    row["failure"] = float(failure)
+    row.update(zip(INTERVAL, interval if interval is not None else (np.nan,)*len(INTERVAL)))
+    return row
+
+
+def append_rows(path, rows):
+    if not rows:
+        return
+    frame = pd.DataFrame(rows, columns=COLUMNS)
+    for column in COLUMNS:
+        if column not in ITEMSIZES:
+            frame[column] = frame[column].astype(float)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock, pd.HDFStore(path, mode="a") as hdf:
+        hdf.append(KEY, frame, format="table", index=False,
+                   data_columns=["subject", "status", "time"],
+                   min_itemsize=ITEMSIZES)
+
+
+def append_point(path, subject, time, status, cond, sol=None,
+                 performance=np.nan, failure=np.nan, sampler="", interval=None):
+    append_rows(path, [point_row(subject, time, status, cond, sol, performance, failure,
+                                 sampler, interval)])
+
+
+'''
+Reads the experiment table of one condition: the session tables in the store_path
+folder at path (or a single table file), in subject and time order. columns and
+where (a PyTables query on subject, status or time) restrict what is read.
+'''
+def load_points(path, columns=None, where=None):
+    if os.path.isdir(path):
+        paths = [os.path.join(path, x) for x in sorted(os.listdir(path)) if x.endswith(".h5")]
+    else:
+        paths = [path] if os.path.isfile(path) else []
+    with _lock:
+        frames = [pd.read_hdf(x, KEY, columns=columns, where=where) for x in paths]
+    if not frames:
+        return pd.DataFrame(columns=columns or COLUMNS)
+    points = pd.concat(frames, ignore_index=True)
+    if {"subject", "time"} <= set(points.columns):
+        points = points.sort_values(["subject", "time"], kind="mergesort", ignore_index=True)
+    return points
+
+
+def _legacy_rows(folder_name, subject, solved):
+    subj_path = folder_name + subject + "/"
+    rows = []
+    for filename in os.listdir(subj_path):
+        for status in STATUSES[::-1]:
+            if filename.endswith("_%s.txt" % status):
+                break
+        else:
+            continue
+        stamp = filename[:-len("_%s.txt" % status)]
+        if not stamp.isdigit():
+            continue
+        with open(subj_path + filename, "r") as f:
+            lines = f.readlines()
+        cond = lines[0].strip() if lines else ""
+        performance = failure = np.nan
+        sampler = ""
+        interval = None
+        if status in ["point", "repeat"] and len(lines) > 1:
+            performance, failure, sampler = read_results(lines[1])
+            interval = read_interval(lines[1])
+        sol = None
+        if status == "point" and solved and os.path.isfile(subj_path + stamp):
+            sol = load_solution(subj_path + stamp)
+        rows.append(point_row(subject, int(stamp), status, cond, sol, performance, failure,
+                              sampler, interval))
+    return rows
+
+
+'''
+One-shot import of a legacy data/<condition>/<subject>/ tree into its own table
+at path (the "legacy" session of store_path(folder_name) by default), replacing
+any earlier import. Subject folders ("<start>" or "<start> (ID n)") of sessions
+that recorded their own table are left out, so no point is read twice. The solved
+variables are only read from the point snapshots (or pickles) if solved is set.
+'''
+def import_legacy(folder_name, path=None, solved=True):
+    path = path or session_path(folder_name, "legacy")
+    if os.path.isfile(path):
+        os.remove(path)
+    recorded = recorded_sessions(folder_name)
+    rows = []
+    for subject in sorted(os.listdir(folder_name)):
+        if os.path.isdir(folder_name + subject) and subject.split(" ")[0] not in recorded:
+            rows.extend(_legacy_rows(folder_name, subject, solved))
+    rows.sort(key=lambda row: (row["subject"], row["time"]))
+    append_rows(path, rows)
+    return len(rows)
@@ -0,0 +1,160 @@
+import pickle
+import threading
+from multiprocessing import Pool
+import numpy as np
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import cKDTree
+from gpkit import NamedVariables
+from simpleac import SimPleAC
+from monte_carlo import monte_carlo_batch
+
+# slider boxes of the control-base and margin-base notebooks
+LEVER_RANGES = {
+    "control": [(10, 25), (5, 100), (0.01, 5), (0.1, 0.7)],
+    "margin": [(0.5, 3), (0.5, 3), (0.5, 3), (0.5, 3)],
+}
+
+
+def control_subs(values):
+    wing_length, wing_area, fuel_volume_available, lift_coefficient = values
+    return {
+      "S": wing_area,
+      "A": wing_length**2/float(wing_area),
+      "V_{f_{avail}}": fuel_volume_available,
+      "C_L": lift_coefficient
+    }
+
+
+def margin_subs(values):
+    wing_weight_margin, tsfc_margin, takeoff_speed_margin, range_margin = values
+    return {
+        "m_ww": wing_weight_margin,
+        "m_tsfc": tsfc_margin,
+        "m_vmin": takeoff_speed_margin,
+        "m_range": range_margin
+    }
+
+
+LEVER_SUBS = {"control": control_subs, "margin": margin_subs}
+
+
+def latin_hypercube(n, ranges, seed=0):
+    rng = np.random.default_rng(seed)
+    unit = np.array([(rng.permutation(n) + rng.random(n))/n for _ in ranges]).T
+    lo, hi = np.array(ranges, dtype=float).T
+    return lo + unit*(hi - lo)
+
+
+def _localsolve(args):
+    condition, values = args
+    NamedVariables.reset_modelnumbers()
+    m = SimPleAC()
+    m.substitutions.update(LEVER_SUBS[condition](values))
+    try:
+        return m.localsolve(verbosity=0)
+    except Exception:
+        return None
+
+
+class Surrogate(object):
+    '''
+    Interpolates (W_f, failure %) over one condition's lever box from sampled
+    lever positions (infeasible ones have NaN results). The error estimate at a
+    query is the mean leave-one-out error of the nearest feasible samples.
+    '''
+    def __init__(self, condition, levers, results, neighbors=5):
+        self.condition = condition
+        self.ranges = np.array(LEVER_RANGES[condition], dtype=float)
+        self.levers = np.array(levers, dtype=float)
+        self.results = np.array(results, dtype=float)
+        self.neighbors = neighbors
+        self.lock = threading.Lock()
+        self.fit()
+
+    def _scaled(self, levers):
+        lo, hi = self.ranges.T
+        return (np.atleast_2d(levers) - lo)/(hi - lo)
+
+    def _interpolator(self, keep):
+        return RBFInterpolator(self._scaled(self.levers[keep]), self.results[keep],
+                               kernel="thin_plate_spline")
+
+    def fit(self):
+        self.feasible = ~np.isnan(self.results).any(axis=1)
+        self.interpolator = self._interpolator(self.feasible)
+        self.tree = cKDTree(self._scaled(self.levers))
+        self.errors = np.full(self.results.shape, np.nan)
+        for i in np.flatnonzero(self.feasible):
+            keep = self.feasible.copy()
+            keep[i] = False
+            predicted = self._interpolator(keep)(self._scaled(self.levers[i]))[0]
+            self.errors[i] = np.abs(predicted - self.results[i])
+
+    def predict(self, levers):
+        # (performance, failure, performance error, failure error),
+        # or None where the nearest sample was infeasible
+        with self.lock:
+            x = self._scaled(levers)
+            _, nearest = self.tree.query(x, k=min(self.neighbors, len(self.levers)))
+            nearest = np.atleast_1d(nearest[0])
+            if not self.feasible[nearest[0]]:
+                return None
+            performance, failure = self.interpolator(x)[0]
+            nearest = nearest[self.feasible[nearest]]
+            perf_err, fail_err = np.nanmean(self.errors[nearest], axis=0)
+            return (performance, min(max(failure, 0.), 100.), perf_err, fail_err)
+
+    def add(self, levers, performance, failure):
+        # the error recorded for a new point is how far off the surrogate was
+        # before it knew the point
+        with self.lock:
+            result = np.array([performance, failure], dtype=float)
+            error = np.full(2, np.nan)
+            if not np.isnan(result).any() and self.feasible.any():
+                error = np.abs(self.interpolator(self._scaled(levers))[0] - result)
+            self.levers = np.vstack([self.levers, levers])
+            self.results = np.vstack([self.results, result])
+            self.errors = np.vstack([self.errors, error])
+            self.feasible = ~np.isnan(self.results).any(axis=1)
+            self.interpolator = self._interpolator(self.feasible)
+            self.tree = cKDTree(self._scaled(self.levers))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def load_surrogate(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+'''
+Samples n lever positions of condition ("control" or "margin") on a Latin
+hypercube over the notebook slider boxes, localsolves and Monte Carlo scores
+them with processes workers, and fits a Surrogate (saved to path if given).
+'''
+def build_surrogate(condition, n=200, seed=0, processes=None, path=None, mc_seed=246):
+    levers = latin_hypercube(n, LEVER_RANGES[condition], seed)
+    with Pool(processes) as pool:
+        sols = pool.map(_localsolve, [(condition, values) for values in levers])
+    feasible = [i for i, sol in enumerate(sols) if sol is not None]
+    results = np.full((n, 2), np.nan)
+    if feasible:
+        scored = monte_carlo_batch([sols[i] for i in feasible], seed=mc_seed,
+                                   processes=processes)
+        results[feasible, 0] = scored["perf"]
+        results[feasible, 1] = scored["fail"]
+    surrogate = Surrogate(condition, levers, results)
+    if path:
+        surrogate.save(path)
+    return surrogate
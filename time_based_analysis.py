@@ -3,12 +3,13 @@ import numpy as np
 import scipy.stats as stats
 import scipy.spatial as spatial
 import itertools
+from multiprocessing import Pool
 import plotly.graph_objects as go
 
-from analysis import folder_names, conditions, corrected_points
+from analysis import folder_names, conditions, corrected_points, heatmap_frames, regions_of
 
 
-def animated_heatmap(time_points, times, condition):
+def animated_heatmap(time_points, times, condition, max_frames=None):
     fig_dict = {
         "data": [],
         "layout": {},
@@ -105,47 +106,13 @@ def animated_heatmap(time_points, times, condition):
         "colorscale": "magma"      
     }
     fig_dict["data"].append(data_dict)
-    i = 0
-    prev_i = 0
-    hmap = np.zeros((51, 112)) +.0001
-    for t in times:
-        frame = {"data": [], "name": str(t)}
-        while i < len(time_points) and time_points["time"][i] < t:
-            i+=1
-        for _, perf, fail, _ in time_points[prev_i:i]:
-            i_col = min(max(int((perf-900)/10)+1, 0), 111)
-            i_row = int(fail/2)
-            hmap[i_row, i_col] += 1
-        prev_i = i
-        hmap = np.log(hmap)
-        frame["data"] = [{
-            "type": "heatmap",
-            "x": x,
-            "y": y,
-            "z": hmap,
-            "zmin": -1,
-            "zmax": np.log(80),
-            "colorbar": {
-                "tickvals": tick_vals,
-                "ticktext": ticks},
-            "colorscale": "magma"      
-        }]
-        fig_dict["frames"].append(frame)
-        slider_step = {"args": [
-            [t],
-            {"frame": {"duration": 300, "redraw": True},
-             "mode": "immediate",
-             "transition": {"duration": 300}}
-        ],
-            "label": t,
-            "method": "animate"}
-        sliders_dict["steps"].append(slider_step)
-    
-    fig_dict["layout"]["sliders"] = [sliders_dict]
+    hmaps = np.log(heatmap_frames(time_points["perf"], time_points["fail"],
+                                  time_points["time"], times) + .0001)
+    add_frames(fig_dict, sliders_dict, times, [{"z": hmap} for hmap in hmaps], max_frames)
     return fig_dict
 
 
-def animated_convex_hull(chulls, times, condition):
+def animated_convex_hull(chulls, times, condition, max_frames=None):
     fig_dict = {
         "data": [],
         "layout": {},
@@ -231,23 +198,32 @@ def animated_convex_hull(chulls, times, condition):
         "mode": "lines+markers"
     }
     fig_dict["data"].append(data_dict)
-    for i in range(len(times)):
-        t = times[i]
-        hull = chulls[i]
-        x = hull.points[hull.vertices,0]
-        x = np.append(x, hull.points[hull.vertices,0][0])
-        y = hull.points[hull.vertices,1]
-        y = np.append(y, hull.points[hull.vertices,1][0])
-        frame = {"data": [], "name": str(t)}
-        frame["data"] = [{
-            "type": "scatter",
-            "x": x,
-            "y": y,
-            "mode": "lines+markers"
-        }]
-        fig_dict["frames"].append(frame)
+    add_frames(fig_dict, sliders_dict, times,
+               [{"x": hull[:, 0], "y": hull[:, 1]} for hull in chulls], max_frames)
+    return fig_dict
+
+
+'''
+Appends a frame and slider step per time to an animated figure dict. A frame only
+carries the trace properties that change (rounded to decimals, as plain lists);
+the rest stay on the figure's trace. Frames identical to the last one kept are
+dropped, and at most max_frames evenly spaced ones are kept (always the last).
+'''
+def add_frames(fig_dict, sliders_dict, times, frames_data, max_frames=None, decimals=3):
+    kept = []
+    last = None
+    for t, data in zip(times, frames_data):
+        data = {key: np.round(np.asarray(value, dtype=float), decimals).tolist()
+                for key, value in data.items()}
+        if data != last:
+            kept.append((t, data))
+            last = data
+    if max_frames is not None and len(kept) > max_frames:
+        kept = [kept[i] for i in np.unique(np.linspace(0, len(kept) - 1, max_frames).round().astype(int))]
+    for t, data in kept:
+        fig_dict["frames"].append({"data": [data], "name": str(t)})
         slider_step = {"args": [
-            [t],
+            [str(t)],
             {"frame": {"duration": 300, "redraw": True},
              "mode": "immediate",
              "transition": {"duration": 300}}
@@ -255,49 +231,181 @@ def animated_convex_hull(chulls, times, condition):
             "label": t,
             "method": "animate"}
         sliders_dict["steps"].append(slider_step)
-    
     fig_dict["layout"]["sliders"] = [sliders_dict]
-    return fig_dict
+
+
+class HullTracker(object):
+    '''
+    Convex hull of a growing set of (perf, fail) points. Points are only kept
+    until they span the plane; from then on Qhull adds each batch to the hull
+    it already has. While the points are collinear (or fewer than three) the
+    "hull" is the segment between the extreme points, with zero area.
+    '''
+    def __init__(self):
+        self.points = np.empty((0, 2))
+        self.hull = None
+
+    def add(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not len(points):
+            return
+        if self.hull is not None:
+            self.hull.add_points(points)
+            return
+        self.points = np.vstack([self.points, points])
+        if np.linalg.matrix_rank(self.points - self.points[0]) == 2:
+            self.hull = spatial.ConvexHull(self.points, incremental=True)
+
+    def area(self):
+        # like ConvexHull.area, the perimeter of the 2-D hull
+        return self.hull.area if self.hull is not None else 0.
+
+    def vertices(self):
+        # closed outline of the hull
+        if self.hull is not None:
+            outline = self.hull.points[self.hull.vertices]
+        elif len(self.points):
+            direction = self.points[-1] - self.points[0]
+            along = self.points @ direction
+            outline = self.points[[np.argmin(along), np.argmax(along)]]
+        else:
+            return np.empty((0, 2))
+        return np.vstack([outline, outline[:1]])
 
 
 def convex_hull_time(time_points, times, condition):
+    # time_points sorted by time; each step adds the points from before its time
+    cuts = np.searchsorted(time_points["time"], times, side="left")
+    perf = time_points["perf"].astype(float)
+    fail = time_points["fail"].astype(float)
+    tracker = HullTracker()
     convex_hulls = []
-    areas = []
-    norm_areas_ver = []
-    norm_areas_hor = []
-    this_time_points = []
-    i = 0
+    areas = np.zeros(len(times))
     prev_i = 0
-    min_fail = 100
-    max_fail = 0
-    min_perf = 5000
-    max_perf = 0
-    for t in times:
-        while i < len(time_points) and time_points["time"][i] < t:
-            min_fail = time_points["fail"][i] if min_fail > time_points["fail"][i] else min_fail
-            max_fail = time_points["fail"][i] if max_fail < time_points["fail"][i] else max_fail
-            min_perf = time_points["perf"][i] if min_perf > time_points["perf"][i] else min_perf
-            max_perf = time_points["perf"][i] if max_perf < time_points["perf"][i] else max_perf
-            i+=1
-        this_time_points.extend([(perf, fail) for _, perf, fail, _ in time_points[prev_i:i]])
+    for step, i in enumerate(cuts):
+        tracker.add(np.column_stack([perf[prev_i:i], fail[prev_i:i]]))
         prev_i = i
-        try:
-            convex_hulls.append(spatial.ConvexHull(this_time_points))
-            areas.append(convex_hulls[-1].area)
-            norm_areas_ver.append(areas[-1]/(max_perf-min_perf))
-            norm_areas_hor.append(areas[-1]/(max_fail-min_fail))
-        except Exception:
-            fake_chull = lambda: None
-            setattr(fake_chull, 'area', 0)
-            setattr(fake_chull, 'points', np.array([[0,0],[0,0]]))
-            setattr(fake_chull, 'vertices', np.array([0,0]))
-            convex_hulls.append(fake_chull)
-            areas.append(0)
-            norm_areas_ver.append(0)
-            norm_areas_hor.append(0)
+        convex_hulls.append(tracker.vertices())
+        areas[step] = tracker.area()
+    perf_range = fail_range = np.zeros(len(times))
+    if len(perf):
+        seen = np.maximum(cuts - 1, 0)
+        perf_range = (np.maximum.accumulate(perf) - np.minimum.accumulate(perf))[seen]
+        fail_range = (np.maximum.accumulate(fail) - np.minimum.accumulate(fail))[seen]
+    # a hull with area spans both axes, so the ranges are only zero where the area is
+    norm_areas_ver = np.divide(areas, perf_range, out=np.zeros(len(times)), where=areas > 0)
+    norm_areas_hor = np.divide(areas, fail_range, out=np.zeros(len(times)), where=areas > 0)
     return convex_hulls, areas, norm_areas_ver, norm_areas_hor
 
     
+'''
+Every time series of one condition in a single pass over its points, either for
+each subject (by_subject) or for the condition as a whole: the number of points,
+the points in each region (green, yellow, blue, outside), and the convex hull
+area with its normalized areas, all as (groups, len(times)) arrays. A step at
+time t counts the points from before t.
+'''
+def time_series(time_points, times, by_subject=True):
+    times = np.asarray(times)
+    if by_subject:
+        subjects, group = np.unique(time_points["idnum"], return_inverse=True)
+    else:
+        subjects, group = np.array([""]), np.zeros(len(time_points), dtype=int)
+    n, n_times = len(subjects), len(times)
+    order = np.lexsort((time_points["time"], group))
+    group = group[order]
+    perf = time_points["perf"][order].astype(float)
+    fail = time_points["fail"][order].astype(float)
+    # bucket k holds the points first counted at step k (n_times: never)
+    bucket = np.searchsorted(times, time_points["time"][order], side="right")
+    cell = group*(n_times + 1) + bucket
+    n_cells = n*(n_times + 1)
+
+    series = {"subjects": subjects}
+    counts = np.bincount(cell, minlength=n_cells).reshape(n, n_times + 1)
+    series["count"] = np.cumsum(counts, axis=1)[:, :n_times]
+    occupancy = np.bincount(cell*4 + regions_of(perf, fail), minlength=4*n_cells)
+    occupancy = np.cumsum(occupancy.reshape(n, n_times + 1, 4), axis=1)[:, :n_times]
+    for region, name in enumerate(["green", "yellow", "blue", "outside"]):
+        series[name] = occupancy[:, :, region]
+
+    ranges = {}
+    for name, values in [("perf", perf), ("fail", fail)]:
+        low = np.full(n_cells, np.inf)
+        high = np.full(n_cells, -np.inf)
+        np.minimum.at(low, cell, values)
+        np.maximum.at(high, cell, values)
+        low = np.minimum.accumulate(low.reshape(n, n_times + 1), axis=1)[:, :n_times]
+        high = np.maximum.accumulate(high.reshape(n, n_times + 1), axis=1)[:, :n_times]
+        ranges[name] = np.where(np.isfinite(low), high - low, 0.)
+
+    # the hull is the one running state that needs each step's new points
+    starts = np.searchsorted(cell, np.arange(n)*(n_times + 1), side="left")
+    cuts = np.searchsorted(cell, np.arange(n)[:, None]*(n_times + 1) + np.arange(n_times),
+                           side="right")
+    areas = np.zeros((n, n_times))
+    for g in range(n):
+        tracker = HullTracker()
+        prev_i = starts[g]
+        for step, i in enumerate(cuts[g]):
+            if i > prev_i:
+                tracker.add(np.column_stack([perf[prev_i:i], fail[prev_i:i]]))
+                prev_i = i
+            areas[g, step] = tracker.area()
+    series["area"] = areas
+    series["norm_area_ver"] = np.divide(areas, ranges["perf"], out=np.zeros_like(areas),
+                                        where=areas > 0)
+    series["norm_area_hor"] = np.divide(areas, ranges["fail"], out=np.zeros_like(areas),
+                                        where=areas > 0)
+    return series
+
+
+TIME_DTYPE = [('time',int), ('perf',float), ('fail',int), ('idnum','U25')]
+METRICS = ["count", "green", "yellow", "blue", "outside", "area", "norm_area_ver", "norm_area_hor"]
+
+
+def condition_time_points(folder_name):
+    _, _, points, _ = corrected_points(folder_name)
+    time_points = np.array([(points[point], *point) for point in points], dtype=TIME_DTYPE)
+    time_points.sort(order="time")
+    return time_points
+
+
+def subject_groups(time_points):
+    # {idnum: that subject's points, in time order}, from one sort
+    order = np.lexsort((time_points["time"], time_points["idnum"]))
+    grouped = time_points[order]
+    idnums, starts = np.unique(grouped["idnum"], return_index=True)
+    return dict(zip(idnums, np.split(grouped, starts[1:])))
+
+
+def _subject_frame(args):
+    condition, idnum, time_points, times = args
+    series = time_series(time_points, times, by_subject=False)
+    return pd.DataFrame({
+        "condition": condition,
+        "subject": idnum,
+        "time": np.tile(times, len(METRICS)),
+        "metric": np.repeat(METRICS, len(times)),
+        "value": np.concatenate([series[metric][0] for metric in METRICS]).astype(float),
+    })
+
+
+'''
+Time series of every subject of every condition, one (condition, subject) per task
+on processes workers, as a tidy DataFrame of condition, subject, time, metric
+(see METRICS) and value.
+'''
+def subject_time_series(times, processes=None):
+    tasks = []
+    for folder_name, condition in zip(folder_names, conditions):
+        groups = subject_groups(condition_time_points(folder_name))
+        tasks.extend((condition, idnum, points, list(times)) for idnum, points in groups.items())
+    with Pool(processes) as pool:
+        frames = pool.map(_subject_frame, tasks)
+    return pd.concat(frames, ignore_index=True)
+
+
 def plot_all_over_time(all_data, stat_name, times):
     fig = go.Figure(
         data=[go.Scatter(
@@ -327,7 +435,14 @@ def plot_all_over_time(all_data, stat_name, times):
     fig.show()
 
 
-def plot_avg_over_time(all_data, stat_name, times):
+def plot_avg_over_time(all_data, stat_name, times, metric=None):
+    if isinstance(all_data, pd.DataFrame):
+        # tidy subject_time_series output
+        if metric is not None:
+            all_data = all_data[all_data["metric"] == metric]
+        means = all_data.groupby(["condition", "time"])["value"].mean()
+        all_data = {condition: {"mean": means[condition].reindex(times).values}
+                    for condition in means.index.unique("condition")}
     fig = go.Figure(
         data=[go.Scatter(
             x=times,
@@ -363,32 +478,23 @@ if __name__ == "__main__":
     all_norm_areas_hor = {condition: {} for condition in conditions}
     # times = list(range(0, 1801, 20))
     times = list(range(1, 1801, 20))
-    dtype = [('time',int), ('perf',float), ('fail',int), ('idnum','U25')]
     for folder_name, condition in list(zip(folder_names, conditions)):
-        _, _, points, _ = corrected_points(folder_name)
-        time_points = np.array([(points[point], *point) for point in points], dtype=[('time',int), ('perf',float), ('fail',int), ('idnum','U25')])
-        # for idnum in np.unique(time_points["idnum"]):
-        #     this_time_points = np.array([time_point for time_point in time_points if time_point["idnum"] == idnum], dtype=dtype)
-        #     chulls, areas, norm_areas_ver, norm_areas_hor = convex_hull_time(this_time_points, times, condition)
-        #     all_areas[condition][idnum] = areas
-        #     all_norm_areas_ver[condition][idnum] = norm_areas_ver
-        #     all_norm_areas_hor[condition][idnum] = norm_areas_hor
-
-        # time_points.sort(order="time")
+        time_points = condition_time_points(folder_name)
+
         # all_figs[condition] = animated_heatmap(time_points, times, condition)
         # fig = go.Figure(all_figs[condition])
         # fig.show()
         
-        time_points.sort(order="time")
         chulls, areas, norm_areas_ver, norm_areas_hor = convex_hull_time(time_points, times, condition)
         all_areas[condition] = areas
         all_norm_areas_ver[condition] = norm_areas_ver
         all_norm_areas_hor[condition] = norm_areas_hor
         go.Figure(animated_convex_hull(chulls, times, condition)).show()
 
-    # plot_avg_over_time(all_areas, "Area of Convex Hull", times)
-    # plot_avg_over_time(all_norm_areas_ver, "Normalized Area of Convex Hull by Performance", times)
-    # plot_avg_over_time(all_norm_areas_hor, "Normalized Area of Convex Hull by Failure Rate", times)
+    # subject_data = subject_time_series(times)
+    # plot_avg_over_time(subject_data, "Area of Convex Hull", times, "area")
+    # plot_avg_over_time(subject_data, "Normalized Area of Convex Hull by Performance", times, "norm_area_ver")
+    # plot_avg_over_time(subject_data, "Normalized Area of Convex Hull by Failure Rate", times, "norm_area_hor")
 
     # plot_all_over_time(all_areas, "Area of Convex Hull", times)
     # plot_all_over_time(all_norm_areas_ver, "Normalized Area of Convex Hull by Performance", times)